@@ -7,32 +7,88 @@ A collection of tools for having a cached representation of
 a file system.
 """
 
+import ctypes
+import ctypes.util
+import fnmatch
+import gzip
+import hashlib
 import json
 import logging
+import mmap
+import os
+import pickle
+import queue
 import re
+import select
+import struct
+import sys
+import threading
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from itertools import islice
 from pathlib import Path
-from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+from typing import (
+    Any,
+    Callable,
+    ClassVar,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+import numpy as np
 
 from .decorators import timer
-from .path_tools import ensure_dir_exists, folder_get_file_count, make_FS_safe
+from .os_detect import Os
+from .path_tools import (
+    PruneRules,
+    ensure_dir_exists,
+    folder_get_file_count,
+    make_FS_safe,
+)
 from .str_utils import truncate_str
-from .utils import assertTrue, pickle_this, unpickle_this
+from .utils import SQLiteDatabase, assertTrue, pickle_this, unpickle_this
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 LOG = logging.getLogger(__file__)
+REGEX_SPECIAL_CHARACTERS = set(".^$*+?{}[]\\|()")
 
 
-def FSindex(root: Path, condition: Callable = lambda x: True) -> Dict[str, dict]:
+def FSindex(
+    root: Path,
+    condition: Callable = lambda x: True,
+    prune: Optional[PruneRules] = None,
+) -> Dict[str, dict]:
     """Returns a dictionnary such as
     - Contains <root_path:str> as only key
     - Recursively represents contained files and subdirectories, with each their subdirectories, etc
+
+    `prune`: exclusion rules, checked before `condition`; excluded directories are not explored
     """
     assertTrue(root.is_dir(), "Root dir must exist: '{}'", root)
     _root = root.resolve()
 
-    def recursive_collection(_dir: Path):
+    def recursive_collection(_dir: Path, rel_path: str):
         def try_recursion(location: Path):
             try:
-                return recursive_collection(location) if location.is_dir() else None
+                return (
+                    recursive_collection(location, rel_path + location.name + "/")
+                    if location.is_dir()
+                    else None
+                )
             except Exception as e:
                 print(f"FSindex: something went wrong at '{_root}'. Error:\n{e}")
                 return None
@@ -40,14 +96,1298 @@ def FSindex(root: Path, condition: Callable = lambda x: True) -> Dict[str, dict]
         return {
             str(child.name): try_recursion(child)
             for child in _dir.iterdir()
-            if condition(child)
+            if not (prune and prune.excludes(rel_path + child.name, child.is_dir()))
+            and condition(child)
         }
 
     root_s = _root.as_posix()
     if root_s[-1] == "/":
         root_s = root_s[:-1]
 
-    return {root_s: recursive_collection(root)}
+    return {root_s: recursive_collection(root, "")}
+
+
+DirSignature = Tuple[int, int, int]
+EntryMetadata = Tuple[int, int, int, int]
+DIGEST_SIZE = 16  # bytes, see `tree_digests`
+# `CompactFS` table: an array, or a view on a snapshot (see `CompactFS.from_buffer`)
+Table = Union[array, memoryview]
+
+
+def directory_signature(stat_result: os.stat_result) -> DirSignature:
+    """Returns a directory's (<mtime (ns)>, <ctime (ns)>, <inode>) signature. A directory's mtime
+    changes whenever an entry is created, deleted or renamed in it, so an unchanged signature
+    means its listing is unchanged. ctime is included because tools like ``rsync -t`` restore
+    directory mtimes after changing their content.
+    """
+    return (stat_result.st_mtime_ns, stat_result.st_ctime_ns, stat_result.st_ino)
+
+
+def entry_metadata(stat_result: Optional[os.stat_result]) -> EntryMetadata:
+    """Returns an entry's (<size (bytes)>, <mtime (ns)>, <inode>, <device>) metadata; all zeros
+    if `stat_result` is None (entry couldn't be accessed)."""
+    if stat_result is None:
+        return (0, 0, 0, 0)
+    return (
+        stat_result.st_size,
+        stat_result.st_mtime_ns,
+        stat_result.st_ino,
+        stat_result.st_dev,
+    )
+
+
+def FSscan(
+    root: Path,
+    condition: Callable[[os.DirEntry], bool] = lambda x: True,
+    workers: Optional[int] = None,
+    prune: Optional[PruneRules] = None,
+) -> Dict[str, Optional[dict]]:
+    """Faster alternative to `FSindex`, returning the same dictionnary.
+
+    Differences with `FSindex`:
+     - `condition` is called on `os.DirEntry` objects instead of `Path`; they expose `name`,
+       `is_dir()` and `is_file()` like `Path` does, but use the type information returned by the
+       directory listing, so no additional `stat` call is needed for most entries
+     - directory listings are distributed across a pool of at most `workers` threads (default:
+       `ThreadPoolExecutor`'s default), which greatly helps on high-latency (network) filesystems
+
+    `prune`: exclusion rules, checked before `condition`; excluded directories are not explored.
+    Defaults to `condition`'s rules if it is a `ScanFilter` with `prune` patterns.
+    """
+    return _scan_tree(root, condition, workers, prune=prune)[0]
+
+
+def _list_directory(
+    _dir: str,
+    prefix: str,
+    condition: Callable[[os.DirEntry], bool],
+    prune: Optional[PruneRules],
+    metadata: bool,
+) -> Tuple[List[Tuple[str, bool]], Optional[List[EntryMetadata]]]:
+    """Returns (<(name, is directory) of entries of `_dir`>, <their `entry_metadata`, if
+    `metadata` is True>). Entries excluded by `prune` (matched on `prefix` + name) or rejected
+    by `condition` are left out."""
+    entries = []
+    entries_metadata: Optional[List[EntryMetadata]] = [] if metadata else None
+    with os.scandir(_dir) as it:
+        for entry in it:
+            is_dir = entry.is_dir()
+            if prune and prune.excludes(prefix + entry.name, is_dir):
+                continue
+            if not condition(entry):
+                continue
+            entries.append((entry.name, is_dir))
+            if entries_metadata is not None:
+                entries_metadata.append(entry_metadata(safe_stat(entry)))
+    return entries, entries_metadata
+
+
+def _walk_tree(
+    root_context: tuple,
+    list_directory: Callable[[tuple], Any],
+    on_listed: Callable[[tuple, Any], Iterable[tuple]],
+    workers: Optional[int],
+) -> None:
+    """Walking engine behind scans: directories are listed by a pool of at most `workers`
+    threads, and listings are gathered by the current thread, so that only it edits results.
+
+    Each directory is described by a context, a tuple starting with the directory's path:
+    `list_directory(<context>)` is called in a worker thread, then `on_listed(<context>,
+    <listing>)` is called in the current thread (in completion order) and returns contexts of
+    subdirectories to list. Errors listing the root (`root_context`) are raised, other
+    directories are skipped with a warning.
+    """
+    completed: "queue.Queue[Tuple[Future, tuple]]" = queue.Queue()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def submit(context: tuple) -> None:
+            executor.submit(list_directory, context).add_done_callback(
+                lambda future: completed.put((future, context))
+            )
+
+        submit(root_context)
+        pending = 1
+        while pending:
+            future, context = completed.get()
+            pending -= 1
+            try:
+                listing = future.result()
+            except Exception as e:
+                if context is root_context:
+                    raise
+                LOG.warning(
+                    "FSscan: something went wrong at '%s'. Error: %s", context[0], e
+                )
+                continue
+            for child_context in on_listed(context, listing):
+                submit(child_context)
+                pending += 1
+
+
+def _root_name(root: Path) -> str:
+    """Returns name of `root` in scan results (resolved posix path, without trailing '/')"""
+    root_s = root.resolve().as_posix()
+    return root_s[:-1] if root_s[-1] == "/" else root_s
+
+
+def _scan_tree(
+    root: Path,
+    condition: Callable[[os.DirEntry], bool],
+    workers: Optional[int],
+    track_signatures: bool = False,
+    previous_fs: Optional[dict] = None,
+    previous_signatures: Optional[Dict[str, DirSignature]] = None,
+    prune: Optional[PruneRules] = None,
+    prune_base: str = "",
+) -> Tuple[Dict[str, Optional[dict]], Dict[str, DirSignature]]:
+    """Scanning engine behind `FSscan`. Returns (<fs>, <signatures>). See `_scan_compact` for
+    the compact representation.
+
+    `track_signatures`: if True, `signatures` maps each listed directory's path (relative
+    to root, posix-style, root being '') to its `directory_signature`.
+
+    `previous_fs`, `previous_signatures`: result of a previous scan (with `track_signatures=True`)
+    of the same root with the same condition. Directories with unchanged signature are not listed
+    again, their previous content is reused instead (implies `track_signatures=True`).
+
+    `prune`: exclusion rules (default: those of `condition`, if it is a `ScanFilter`), checked on
+    paths relative to root prefixed with `prune_base` (path of `root` relative to the rules' root,
+    with a trailing '/'). Excluded entries are neither listed nor explored.
+    """
+    assertTrue(root.is_dir(), "Root dir must exist: '{}'", root)
+    if prune is None and isinstance(condition, ScanFilter):
+        prune = condition.prune_rules
+    if previous_fs is not None:
+        track_signatures = True
+    _previous_signatures = previous_signatures or {}
+
+    # Context: (<path>, <path relative to root>, <previous content>, <parent>, <name in parent>)
+    def list_directory(
+        context: tuple,
+    ) -> Tuple[List[Tuple[str, bool]], Optional[DirSignature]]:
+        """Returns (<(name, is directory) of entries>, <signature>)"""
+        _dir, rel_path, previous, _, _ = context
+        signature = directory_signature(os.stat(_dir)) if track_signatures else None
+        if previous is not None and _previous_signatures.get(rel_path) == signature:
+            return [
+                (name, children is not None) for name, children in previous.items()
+            ], signature
+        prefix = prune_base + (rel_path + "/" if rel_path else "")
+        return _list_directory(_dir, prefix, condition, prune, False)[0], signature
+
+    signatures: Dict[str, DirSignature] = {}
+
+    def on_listed(context: tuple, listing: tuple) -> List[tuple]:
+        _dir, rel_path, previous, parent, name = context
+        entries, signature = listing
+        # Subdirectories are None until listed
+        content: Dict[str, Optional[dict]] = dict.fromkeys(name for name, _ in entries)
+        parent[name] = content
+        if signature is not None:
+            signatures[rel_path] = signature
+        return [
+            (
+                os.path.join(_dir, child_name),
+                f"{rel_path}/{child_name}" if rel_path else child_name,
+                previous.get(child_name) if previous else None,
+                content,
+                child_name,
+            )
+            for child_name, is_dir in entries
+            if is_dir
+        ]
+
+    root_s = _root_name(root)
+    res: Dict[str, Optional[dict]] = {root_s: None}
+    _walk_tree(
+        (
+            str(root.resolve()),
+            "",
+            previous_fs.get(root_s) if previous_fs else None,
+            res,
+            root_s,
+        ),
+        list_directory,
+        on_listed,
+        workers,
+    )
+    return res, signatures
+
+
+@dataclass
+class _Listing:
+    """Directory listing gathered by `_scan_compact`"""
+
+    names: bytes  # encoded, NUL-terminated names of entries, concatenated
+    metadata: Optional[List[array]]  # one array per `entry_metadata` field
+    signature: Optional[DirSignature]
+    children: Dict[int, "_Listing"] = field(default_factory=dict)  # by entry position
+
+
+def _scan_compact(
+    root: Path,
+    condition: Callable[[os.DirEntry], bool],
+    workers: Optional[int],
+    previous: Optional["CompactFS"] = None,
+    metadata: bool = False,
+    prune: Optional[PruneRules] = None,
+) -> "CompactFS":
+    """Equivalent of `_scan_tree` (with `track_signatures=True`) producing a `CompactFS`
+    directly, without building a nested dictionnary: each listing is encoded as soon as it is
+    made, and listings are laid out in depth-first order once the scan is complete. Directory
+    signatures are stored in the tree (see `CompactFS.signature`).
+
+    `previous`: result of a previous scan of the same root with the same condition (and
+    `metadata`). Directories with unchanged signature are not listed again, their previous
+    content is read from `previous` tables instead.
+
+    `metadata`: if True, the tree has metadata tables (see `entry_metadata`). Entries in
+    directories with unchanged signature are `stat`-ed again, as modifying a file doesn't change
+    its directory's signature.
+    """
+    assertTrue(root.is_dir(), "Root dir must exist: '{}'", root)
+    _root = root.resolve()
+    if prune is None and isinstance(condition, ScanFilter):
+        prune = condition.prune_rules
+    if previous is not None and not previous.has_signatures:
+        previous = None
+    encoding, errors = CompactFS.ENCODING, CompactFS.ENCODING_ERRORS
+
+    def to_tables(rows: List[EntryMetadata]) -> List[array]:
+        columns = list(zip(*rows)) or [()] * len(CompactFS.METADATA_TABLES)
+        return [
+            array(typecode, column)
+            for (_, typecode), column in zip(CompactFS.METADATA_TABLES, columns)
+        ]
+
+    # Context: (<path>, <path relative to root>, <node in previous>, <parent listing>,
+    # <position in parent>)
+    def list_directory(
+        context: tuple,
+    ) -> Tuple[_Listing, List[Tuple[int, str, Optional[int]]]]:
+        """Returns (<listing>, <(position, name, node in previous) of subdirectories>)"""
+        _dir, rel_path, previous_node, _, _ = context
+        signature = directory_signature(os.stat(_dir))
+        if (
+            previous is not None
+            and previous_node is not None
+            and previous.signature(previous_node) == signature
+        ):
+            nodes = list(previous.children(previous_node))
+            names = [previous.name(node) for node in nodes]
+            return (
+                _Listing(
+                    b"".join(
+                        previous.names[
+                            previous.offsets[node] : previous.offsets[node + 1]
+                        ]
+                        for node in nodes
+                    ),
+                    (
+                        to_tables(
+                            [
+                                entry_metadata(safe_stat(os.path.join(_dir, name)))
+                                for name in names
+                            ]
+                        )
+                        if metadata
+                        else None
+                    ),
+                    signature,
+                ),
+                [
+                    (position, name, node)
+                    for position, (name, node) in enumerate(zip(names, nodes))
+                    if previous.is_dir(node)
+                ],
+            )
+
+        prefix = rel_path + "/" if rel_path else ""
+        entries, entries_metadata = _list_directory(
+            _dir, prefix, condition, prune, metadata
+        )
+        previous_subdirectories = (
+            {
+                previous.name(node): node
+                for node in previous.children(previous_node)
+                if previous.is_dir(node)
+            }
+            if previous is not None and previous_node is not None
+            else {}
+        )
+        return (
+            _Listing(
+                b"".join(name.encode(encoding, errors) + b"\0" for name, _ in entries),
+                None if entries_metadata is None else to_tables(entries_metadata),
+                signature,
+            ),
+            [
+                (position, name, previous_subdirectories.get(name))
+                for position, (name, is_dir) in enumerate(entries)
+                if is_dir
+            ],
+        )
+
+    def on_listed(context: tuple, listing: tuple) -> List[tuple]:
+        _dir, rel_path, _, parent, position = context
+        content, subdirectories = listing
+        parent.children[position] = content
+        return [
+            (
+                os.path.join(_dir, name),
+                f"{rel_path}/{name}" if rel_path else name,
+                previous_node,
+                content,
+                child_position,
+            )
+            for child_position, name, previous_node in subdirectories
+        ]
+
+    # The root is the only entry of a pseudo-listing
+    top = _Listing(
+        _root_name(_root).encode(encoding, errors) + b"\0",
+        to_tables([entry_metadata(os.stat(_root))]) if metadata else None,
+        None,
+    )
+    _walk_tree(
+        (str(_root), "", None if previous is None else 0, top, 0),
+        list_directory,
+        on_listed,
+        workers,
+    )
+
+    # Layout: listings are consumed (and released) in depth-first order. A directory that
+    # couldn't be listed has no listing, it is then recorded as a file, like in `_scan_tree`.
+    builder = _CompactFSBuilder(metadata, signatures=True)
+    stack: List[List[Any]] = [[top, top.names.split(b"\0")[:-1], 0]]
+    while stack:
+        frame = stack[-1]
+        listing, names, position = frame
+        if position == len(names):
+            stack.pop()
+            if stack:
+                builder.close_directory()
+            continue
+        frame[2] += 1
+        child = listing.children.pop(position, None)
+        builder.add(
+            names[position],
+            child is not None,
+            (
+                None
+                if listing.metadata is None
+                else tuple(table[position] for table in listing.metadata)
+            ),
+            None if child is None else child.signature,
+        )
+        if child is not None:
+            stack.append([child, child.names.split(b"\0")[:-1], 0])
+    return builder.build()
+
+
+def safe_stat(entry: Union[str, os.DirEntry]) -> Optional[os.stat_result]:
+    """Returns `stat` result for given path or `os.DirEntry`, or None on failure"""
+    try:
+        return entry.stat() if isinstance(entry, os.DirEntry) else os.stat(entry)
+    except OSError:
+        return None
+
+
+def _append(table: array, value: int) -> array:
+    """Appends `value` to `table`; if it doesn't fit, to a copy of `table` with 64-bit items.
+    Returns the table `value` was appended to."""
+    try:
+        table.append(value)
+    except OverflowError:
+        table = array(CompactFS.WIDE_TYPECODES[table.typecode], table)
+        table.append(value)
+    return table
+
+
+def _typecode(table: Table) -> str:
+    """Returns typecode of a `CompactFS` table"""
+    return table.typecode if isinstance(table, array) else table.format
+
+
+def _as_numpy(table: Table) -> np.ndarray:
+    """Returns a numpy view of a `CompactFS` table (no copy)"""
+    return np.frombuffer(table, dtype=_typecode(table))
+
+
+class _CompactFSBuilder:
+    """Builds `CompactFS` tables, nodes being added in depth-first pre-order"""
+
+    def __init__(self, metadata: bool = False, signatures: bool = False) -> None:
+        # 32-bit tables are widened when needed (see `_append`)
+        self.names = bytearray()
+        self.offsets = array("I")
+        self.parents = array("i")
+        self.flags = array("B")
+        self.directories = array("i")
+        self.ends = array("i")
+        self.metadata = (
+            [array(typecode) for _, typecode in CompactFS.METADATA_TABLES]
+            if metadata
+            else None
+        )
+        self.signatures = (
+            [array(typecode) for _, typecode in CompactFS.SIGNATURE_TABLES]
+            if signatures
+            else None
+        )
+        self.digests = bytearray()
+        self._open: List[int] = []  # directories being filled (by rank)
+        # (<name>, <entries for `_directory_digest`>) of directories being filled
+        self._contents: List[Tuple[bytes, list]] = []
+
+    def add(
+        self,
+        name: bytes,
+        is_dir: bool,
+        metadata: Optional[EntryMetadata] = None,
+        signature: Optional[DirSignature] = None,
+    ) -> None:
+        """Adds a node (`name` is encoded, without terminator) to the last directory that isn't
+        closed. Once its content is added, a directory must be closed with `close_directory`.
+        """
+        node = len(self.parents)
+        self.offsets = _append(self.offsets, len(self.names))
+        self.names += name + b"\0"
+        self.parents = _append(
+            self.parents, self.directories[self._open[-1]] if self._open else -1
+        )
+        self.flags.append(CompactFS.DIRECTORY if is_dir else 0)
+        value = None
+        if self.metadata is not None:
+            value = metadata or entry_metadata(None)
+            for table, field_value in zip(self.metadata, value):
+                table.append(field_value)
+        if is_dir:
+            self._open.append(len(self.directories))
+            self._contents.append((name, []))
+            self.directories = _append(self.directories, node)
+            self.ends = _append(self.ends, node + 1)
+            self.digests += bytes(DIGEST_SIZE)
+            if self.signatures is not None:
+                for table, field_value in zip(self.signatures, signature or (0, 0, 0)):
+                    table.append(field_value)
+        elif self._contents:
+            self._contents[-1][1].append((name, None, value))
+
+    def close_directory(self) -> None:
+        """Marks the end of the last directory that isn't closed, and computes its digest"""
+        rank = self._open.pop()
+        try:
+            self.ends[rank] = len(self.parents)
+        except OverflowError:
+            self.ends = array(CompactFS.WIDE_TYPECODES[self.ends.typecode], self.ends)
+            self.ends[rank] = len(self.parents)
+        name, entries = self._contents.pop()
+        digest = _directory_digest(sorted(entries, key=lambda entry: entry[0]))
+        self.digests[rank * DIGEST_SIZE : (rank + 1) * DIGEST_SIZE] = digest
+        if self._contents:
+            self._contents[-1][1].append((name, digest, None))
+
+    def build(self) -> "CompactFS":
+        """Returns the tree"""
+        self.offsets = _append(self.offsets, len(self.names))
+        return CompactFS(
+            bytes(self.names),
+            self.offsets,
+            self.parents,
+            self.flags,
+            self.directories,
+            self.ends,
+            bytes(self.digests),
+            self.metadata,
+            self.signatures,
+        )
+
+
+class CompactFS:
+    """Memory-efficient, read-only equivalent of the nested dictionnary returned by `FSindex`.
+
+    Nodes (files and directories) are numbered in depth-first pre-order: the root is node 0 and
+    each directory's descendants directly follow it. Search results therefore come in the same
+    order as with the nested dictionnary. Storage is made of flat tables:
+     - `names`: all names, UTF-8 encoded and NUL-terminated, concatenated in a single bytes object
+     - `offsets`: start of each name in `names` (plus one last offset: the end of `names`)
+     - `parents`: parent node of each node (-1 for root)
+     - `flags`: bit field for each node (see `CompactFS.DIRECTORY`)
+     - `directories`: directory nodes, in node order; the following tables have one item per
+       directory, in the same order
+     - `ends`: end of each directory's subtree (first node after it)
+     - `digests`: digest of each directory (see `tree_digests`; file values being their metadata
+       if available), concatenated in a single bytes object; used by `CachedFS.diff`
+     - optionally, one table per `entry_metadata` field (see `CompactFS.METADATA_TABLES`), which
+       enable aggregate queries (`subtree_size`, `top_files`)
+     - optionally, one table per `directory_signature` field (see `CompactFS.SIGNATURE_TABLES`),
+       which enable incremental scans
+
+    Node indexes and offsets are 32-bit integers unless the tree is too large. A node costs
+    10 bytes plus its UTF-8 encoded name, plus 24 bytes per directory (48 with signatures) and 32
+    bytes per node with metadata. The nested dictionnary costs a `str` object and a dictionnary
+    slot per node, plus a dictionnary per directory: on a tree of 50,000 short names, compact
+    representation with signatures takes about 3 times less memory (2 MB vs 6.4 MB).
+    """
+
+    DIRECTORY = 1
+    ENCODING = "utf8"
+    ENCODING_ERRORS = "surrogatepass"  # names may contain surrogates (see os.fsdecode)
+    METADATA_TABLES = (
+        ("sizes", "q"),
+        ("mtimes", "q"),
+        ("inodes", "Q"),
+        ("devices", "Q"),
+    )
+    SIGNATURE_TABLES = (
+        ("signature_mtimes", "q"),
+        ("signature_ctimes", "q"),
+        ("signature_inodes", "Q"),
+    )
+    WIDE_TYPECODES = {"I": "Q", "i": "q"}
+
+    def __init__(
+        self,
+        names: Union[bytes, memoryview],
+        offsets: Table,
+        parents: Table,
+        flags: Table,
+        directories: Table,
+        ends: Table,
+        digests: Union[bytes, memoryview],
+        metadata: Optional[Sequence[Table]] = None,
+        signatures: Optional[Sequence[Table]] = None,
+    ) -> None:
+        self.names = names
+        self.offsets = offsets
+        self.parents = parents
+        self.flags = flags
+        self.directories = directories
+        self.ends = ends
+        self.digests = digests
+        # Optional tables are empty when not available (a tree has at least one node)
+        self.sizes, self.mtimes, self.inodes, self.devices = metadata or [
+            array(typecode) for _, typecode in self.METADATA_TABLES
+        ]
+        self.signature_mtimes, self.signature_ctimes, self.signature_inodes = (
+            signatures or [array(typecode) for _, typecode in self.SIGNATURE_TABLES]
+        )
+        self._lowered: Optional[Tuple[bytes, array]] = None
+
+    @property
+    def has_metadata(self) -> bool:
+        """True if metadata tables are available"""
+        return 0 < len(self.sizes)
+
+    @property
+    def has_signatures(self) -> bool:
+        """True if directory signature tables are available"""
+        return 0 < len(self.signature_mtimes)
+
+    @classmethod
+    def from_dict(
+        cls, fs: dict, signatures: Optional[Dict[str, DirSignature]] = None
+    ) -> "CompactFS":
+        """Builds from a `FSindex`-like nested dictionnary
+
+        `signatures`: directory signatures of a scan (see `_scan_tree`), if any
+        """
+        builder = _CompactFSBuilder(signatures=signatures is not None)
+        # Explicit stack of (<iterator over a directory's content>, <path of the directory
+        # relative to root; None for `fs` itself>) to preserve order
+        stack: List[Tuple[Iterator, Optional[str]]] = [(iter(fs.items()), None)]
+        while stack:
+            items, rel_path = stack[-1]
+            for name, children in items:
+                if rel_path is None:
+                    child_rel_path = ""
+                else:
+                    child_rel_path = f"{rel_path}/{name}" if rel_path else name
+                builder.add(
+                    name.encode(cls.ENCODING, cls.ENCODING_ERRORS),
+                    children is not None,
+                    signature=(
+                        signatures.get(child_rel_path)
+                        if signatures is not None and children is not None
+                        else None
+                    ),
+                )
+                if children is not None:
+                    stack.append((iter(children.items()), child_rel_path))
+                    break
+            else:
+                stack.pop()
+                if rel_path is not None:
+                    builder.close_directory()
+
+        return builder.build()
+
+    def _table_names(self) -> List[str]:
+        """Returns names of available tables, in storage order (see `to_buffers`)"""
+        table_names = ["offsets", "parents", "flags", "directories", "ends", "digests"]
+        if self.has_metadata:
+            table_names += [table_name for table_name, _ in self.METADATA_TABLES]
+        if self.has_signatures:
+            table_names += [table_name for table_name, _ in self.SIGNATURE_TABLES]
+        return table_names + ["names"]
+
+    def layout(self) -> List[Tuple[str, str, int]]:
+        """Returns (<table name>, <typecode>, <number of items>) of each table, in storage order
+        (see `to_buffers`)"""
+        return [
+            (
+                table_name,
+                (
+                    "B"
+                    if table_name in ("names", "digests")
+                    else _typecode(getattr(self, table_name))
+                ),
+                len(getattr(self, table_name)),
+            )
+            for table_name in self._table_names()
+        ]
+
+    def to_buffers(self) -> Iterator[Union[Table, bytes]]:
+        """Yields storage as buffers (in native byte order) to be concatenated, without copying
+        tables: each table (see `layout`) followed by padding to a multiple of 8 bytes so that
+        tables stay aligned; see `from_buffer`"""
+        for table_name in self._table_names():
+            table = getattr(self, table_name)
+            yield table
+            yield bytes(-memoryview(table).nbytes % 8)
+
+    @classmethod
+    def from_buffer(
+        cls,
+        buffer: memoryview,
+        layout: List[Tuple[str, str, int]],
+        byteswap: bool = False,
+    ) -> "CompactFS":
+        """Builds from a buffer with content produced by `to_buffers`, given its `layout`.
+        Tables are views on `buffer`, not copies, so nothing is decoded up front: with a
+        memory-mapped file, only accessed parts are read from disk.
+
+        `byteswap`: set to True if buffer was produced on a platform with different byte order;
+        tables are then copied.
+        """
+        names = digests = buffer[:0]
+        tables: Dict[str, Table] = {}
+        position = 0
+        for table_name, typecode, size in layout:
+            nbytes = size * array(typecode).itemsize
+            view = buffer[position : position + nbytes]
+            position += nbytes + (-nbytes % 8)
+            if table_name == "names":
+                names = view
+            elif table_name == "digests":
+                digests = view
+            elif byteswap and typecode != "B":
+                swapped = array(typecode)
+                swapped.frombytes(view)
+                swapped.byteswap()
+                tables[table_name] = swapped
+            else:
+                tables[table_name] = cls._cast(view, typecode)
+
+        def optional_tables(
+            table_names: Tuple[Tuple[str, str], ...],
+        ) -> Optional[List[Table]]:
+            if table_names[0][0] not in tables:
+                return None
+            return [tables[table_name] for table_name, _ in table_names]
+
+        return cls(
+            names,
+            tables["offsets"],
+            tables["parents"],
+            tables["flags"],
+            tables["directories"],
+            tables["ends"],
+            digests,
+            optional_tables(cls.METADATA_TABLES),
+            optional_tables(cls.SIGNATURE_TABLES),
+        )
+
+    @staticmethod
+    def _cast(view: memoryview, typecode: Any) -> memoryview:
+        """Returns `view` cast to given typecode. Note: typecodes come from snapshot headers,
+        whereas `memoryview.cast` type stubs only accept literal formats."""
+        return view.cast(typecode)
+
+    def to_dict(self, metadata: bool = False) -> dict:
+        """Returns the equivalent `FSindex`-like nested dictionnary. If `metadata` is True, files
+        have their metadata (see `entry_metadata`) as value instead of None."""
+        assertTrue(not metadata or self.has_metadata, "No metadata available")
+        res: Dict[str, Any] = {}
+        # Stack of (<node>, <node content>) for the current node's ancestors
+        ancestors: List[Tuple[int, dict]] = [(-1, res)]
+        for node, name in enumerate(self.iter_names()):
+            parent = self.parents[node]
+            while ancestors[-1][0] != parent:
+                ancestors.pop()
+            if self.flags[node] & self.DIRECTORY:
+                content: Dict[str, Optional[dict]] = {}
+                ancestors[-1][1][name] = content
+                ancestors.append((node, content))
+            else:
+                ancestors[-1][1][name] = self.metadata(node) if metadata else None
+        return res
+
+    def signatures(self) -> Dict[str, DirSignature]:
+        """Returns signature of each directory (see `directory_signature`), by path relative to
+        root, posix-style (root being ''), like `_scan_tree`"""
+        assertTrue(self.has_signatures, "No signatures available")
+        root_name = self.name(0)
+        return {
+            self.path(node)[len(root_name) + 1 :]: self._signature(rank)
+            for rank, node in enumerate(self.directories)
+        }
+
+    def path_digests(self) -> Dict[str, bytes]:
+        """Returns digest of each directory by path, like `tree_digests` on `to_dict` output
+        (with metadata, if available)"""
+        digests = {"": self.top_digest()}
+        for rank, node in enumerate(self.directories):
+            digests[self.path(node)] = self._digest(rank)
+        return digests
+
+    def top_digest(self) -> bytes:
+        """Returns digest of the dictionnary containing the root (see `to_dict`)"""
+        return _directory_digest(
+            [(bytes(self.names[: self.offsets[1] - 1]), self.digest(0), None)]
+        )
+
+    def __len__(self) -> int:
+        return len(self.parents)
+
+    def nbytes(self) -> int:
+        """Returns the approximate memory footprint of storage, in bytes"""
+        return sum(
+            len(getattr(self, table_name)) * array(typecode).itemsize
+            for table_name, typecode, _ in self.layout()
+        ) + (0 if self._lowered is None else len(self._lowered[0]))
+
+    def name(self, node: int) -> str:
+        """Returns name of given node"""
+        # str() instead of bytes.decode() to support any buffer (see `from_buffer`)
+        return str(
+            self.names[self.offsets[node] : self.offsets[node + 1] - 1],
+            self.ENCODING,
+            self.ENCODING_ERRORS,
+        )
+
+    def iter_names(self) -> Iterator[str]:
+        """Iterates over node names, in node order"""
+        for node in range(len(self)):
+            yield self.name(node)
+
+    def iter_entries(self) -> Iterator[Tuple[str, str]]:
+        """Iterates over (<name>, <parent path>) for each node, in node order. Parent path is
+        formatted like `CachedFS.search` results ('' for root)"""
+        # Stack of (<node>, <node path>) for the current node's ancestors
+        ancestors: List[Tuple[int, str]] = [(-1, "")]
+        for node, name in enumerate(self.iter_names()):
+            parent = self.parents[node]
+            while ancestors[-1][0] != parent:
+                ancestors.pop()
+            parent_path = ancestors[-1][1]
+            yield name, parent_path
+            if self.flags[node] & self.DIRECTORY:
+                ancestors.append(
+                    (node, f"{parent_path}/{name}" if parent_path else name)
+                )
+
+    def metadata(self, node: int) -> EntryMetadata:
+        """Returns metadata of given node (see `entry_metadata`)"""
+        assertTrue(self.has_metadata, "No metadata available")
+        return (
+            self.sizes[node],
+            self.mtimes[node],
+            self.inodes[node],
+            self.devices[node],
+        )
+
+    def _rank(self, node: int) -> int:
+        """Returns rank of given directory node in directory tables"""
+        return bisect_left(self.directories, node)
+
+    def signature(self, node: int) -> Optional[DirSignature]:
+        """Returns signature of given directory node at last scan, if any (see
+        `directory_signature`)"""
+        if not self.has_signatures or not self.is_dir(node):
+            return None
+        return self._signature(self._rank(node))
+
+    def _signature(self, rank: int) -> DirSignature:
+        """Returns signature of directory with given rank"""
+        return (
+            self.signature_mtimes[rank],
+            self.signature_ctimes[rank],
+            self.signature_inodes[rank],
+        )
+
+    def digest(self, node: int) -> bytes:
+        """Returns digest of given directory node (see `tree_digests`)"""
+        return self._digest(self._rank(node))
+
+    def _digest(self, rank: int) -> bytes:
+        """Returns digest of directory with given rank"""
+        return bytes(self.digests[rank * DIGEST_SIZE : (rank + 1) * DIGEST_SIZE])
+
+    def find(self, path: str) -> Optional[int]:
+        """Returns node with given path (formatted like `CachedFS.search` results), if any"""
+        root_name = self.name(0)
+        if path == root_name:
+            return 0
+        if not path.startswith(root_name + "/"):
+            return None
+        node = 0
+        for part in path[len(root_name) + 1 :].split("/"):
+            for child in self.children(node):
+                if self.name(child) == part:
+                    node = child
+                    break
+            else:
+                return None
+        return node
+
+    def children(self, node: int) -> Iterator[int]:
+        """Iterates over children of given node, in node order. Subtrees of children are skipped,
+        so this costs O(<number of children>)"""
+        child, end = node + 1, self.subtree(node).stop
+        while child < end:
+            yield child
+            child = self.subtree(child).stop
+
+    def subtree(self, node: int) -> range:
+        """Returns range of nodes in subtree of given node (itself included)"""
+        if not self.is_dir(node):
+            return range(node, node + 1)
+        return range(node, self.ends[self._rank(node)])
+
+    def _files_in_subtree(self, node: int) -> Tuple[range, np.ndarray]:
+        """Returns (<subtree range>, <mask of files in subtree>)"""
+        assertTrue(self.has_metadata, "No metadata available")
+        subtree = self.subtree(node)
+        flags = _as_numpy(self.flags)[subtree.start : subtree.stop]
+        return subtree, (flags & self.DIRECTORY) == 0
+
+    def subtree_size(self, node: int = 0) -> int:
+        """Returns total size (bytes) of files in subtree of given node"""
+        subtree, files = self._files_in_subtree(node)
+        sizes = _as_numpy(self.sizes)[subtree.start : subtree.stop]
+        return int(sizes[files].sum())
+
+    def top_files(
+        self, n: int, table: str = "sizes", node: int = 0
+    ) -> List[Tuple[str, int]]:
+        """Returns (<path>, <value>) of the `n` files in subtree of given node with highest value
+        in given metadata table (eg: 'sizes' for largest files, 'mtimes' for newest files),
+        sorted by decreasing value"""
+        assertTrue(
+            table in dict(self.METADATA_TABLES), "Unknown metadata table '{}'", table
+        )
+        subtree, files = self._files_in_subtree(node)
+        values = _as_numpy(getattr(self, table))[subtree.start : subtree.stop]
+        candidates = np.flatnonzero(files)
+        if n < len(candidates):
+            candidates = candidates[np.argpartition(-values[candidates], n)[:n]]
+        candidates = candidates[np.argsort(-values[candidates], kind="stable")]
+        return [(self.path(subtree.start + int(i)), int(values[i])) for i in candidates]
+
+    def is_dir(self, node: int) -> bool:
+        """Returns True if given node is a directory"""
+        return bool(self.flags[node] & self.DIRECTORY)
+
+    def path(self, node: int) -> str:
+        """Returns path of given node, formatted like `CachedFS.search` results"""
+        parts = []
+        while node != -1:
+            parts.append(self.name(node))
+            node = self.parents[node]
+        return "/".join(reversed(parts))
+
+    def search(
+        self, predicate: Callable[[str], bool], stop_at_first: bool = False
+    ) -> List[str]:
+        """Returns paths of nodes whose name satisfies `predicate`"""
+        matches = []
+        for node, name in enumerate(self.iter_names()):
+            if predicate(name):
+                matches.append(self.path(node))
+                if stop_at_first:
+                    break
+        return matches
+
+    def search_substring(
+        self, substring: str, stop_at_first: bool = False
+    ) -> List[str]:
+        """Returns paths of nodes whose name contains `substring` (case insensitive).
+        Faster than `search` because it searches a lower-cased copy of the name table (built on
+        first call) instead of decoding each name.
+        """
+        matches = self.iter_substring(substring)
+        return list(islice(matches, 1) if stop_at_first else matches)
+
+    def iter_substring(self, substring: str) -> Iterator[str]:
+        """Lazy variant of `search_substring`"""
+        if self._lowered is None:
+            lowered_offsets = array("Q")
+            lowered_names = bytearray()
+            for name in self.iter_names():
+                lowered_offsets.append(len(lowered_names))
+                lowered_names += (
+                    name.lower().encode(self.ENCODING, self.ENCODING_ERRORS) + b"\0"
+                )
+            lowered_offsets.append(len(lowered_names))
+            self._lowered = (bytes(lowered_names), lowered_offsets)
+
+        table, offsets = self._lowered
+        needle = substring.lower().encode(self.ENCODING, self.ENCODING_ERRORS)
+        if b"\0" in needle:
+            return
+        position = table.find(needle)
+        while position != -1:
+            node = bisect_right(offsets, position) - 1
+            if len(self) <= node:
+                break
+            yield self.path(node)
+            position = table.find(needle, offsets[node + 1])
+
+
+class NameIndex:
+    """Secondary index over names of a `CompactFS`, for sub-linear name lookups.
+    All lookups are case insensitive and return paths in node order (like `CachedFS.search`).
+
+    Structure (flat tables, like `CompactFS`, so the index stays small compared to the tree):
+     - distinct lower-cased names (encoded, '\\0'-terminated), sorted and concatenated in
+       `names`, starting at `name_offsets`; nodes bearing each name are stored contiguously in
+       `nodes`, between boundaries given by `node_offsets`; makes exact name and prefix lookups
+       a binary search
+     - trigram index: sorted list of 3-byte sequences; ids of names containing each one are
+       stored contiguously in `postings`, between boundaries given by `trigram_offsets`;
+       substring lookups only check names containing the substring's least common trigram
+    """
+
+    def __init__(self, tree: CompactFS) -> None:
+        self.tree = tree
+        lowered = [
+            name.lower().encode(CompactFS.ENCODING, CompactFS.ENCODING_ERRORS)
+            for name in tree.iter_names()
+        ]
+        names = bytearray()
+        self.name_offsets = array("I")
+        self.nodes = array("I")
+        self.node_offsets = array("I")
+        previous = None
+        # Stable sort: nodes bearing the same name stay in node order
+        for node in sorted(range(len(lowered)), key=lowered.__getitem__):
+            name = lowered[node]
+            if name != previous:
+                self.name_offsets = _append(self.name_offsets, len(names))
+                names += name + b"\0"
+                self.node_offsets = _append(self.node_offsets, len(self.nodes))
+                previous = name
+            self.nodes = _append(self.nodes, node)
+        self.name_offsets = _append(self.name_offsets, len(names))
+        self.node_offsets = _append(self.node_offsets, len(self.nodes))
+        self.names = bytes(names)
+        del lowered, names
+
+        # Postings are laid out in two passes: counting, then filling in name order
+        counts: Dict[bytes, int] = {}
+        for name_id in range(len(self)):
+            for trigram in self._trigrams(self._name(name_id)):
+                counts[trigram] = counts.get(trigram, 0) + 1
+        self.trigrams = sorted(counts)
+        self.trigram_offsets = array("I", [0])
+        for trigram in self.trigrams:
+            start = self.trigram_offsets[-1]
+            self.trigram_offsets = _append(
+                self.trigram_offsets, start + counts[trigram]
+            )
+            # From now on: where to write the next name id containing the trigram
+            counts[trigram] = start
+        # Name ids fit in the same type as node ids
+        self.postings = array(self.nodes.typecode, [0]) * self.trigram_offsets[-1]
+        for name_id in range(len(self)):
+            for trigram in self._trigrams(self._name(name_id)):
+                self.postings[counts[trigram]] = name_id
+                counts[trigram] += 1
+
+    def __len__(self) -> int:
+        """Returns number of distinct names"""
+        return len(self.name_offsets) - 1
+
+    @staticmethod
+    def _trigrams(name: bytes) -> Set[bytes]:
+        """Returns distinct 3-byte sequences in `name`"""
+        return {name[i : i + 3] for i in range(len(name) - 2)}
+
+    @staticmethod
+    def _encode(name: str) -> bytes:
+        """Returns `name` as stored in the index"""
+        return name.lower().encode(CompactFS.ENCODING, CompactFS.ENCODING_ERRORS)
+
+    def _name(self, name_id: int) -> bytes:
+        """Returns given name, as stored in the index (see `_encode`)"""
+        return self.names[
+            self.name_offsets[name_id] : self.name_offsets[name_id + 1] - 1
+        ]
+
+    def _lower_bound(self, name: bytes) -> int:
+        """Returns id of the first name not lower than `name` (binary search)"""
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _postings(self, trigram: bytes) -> array:
+        """Returns ids of names containing `trigram`"""
+        trigram_id = bisect_left(self.trigrams, trigram)
+        if trigram_id == len(self.trigrams) or self.trigrams[trigram_id] != trigram:
+            return self.postings[:0]
+        return self.postings[
+            self.trigram_offsets[trigram_id] : self.trigram_offsets[trigram_id + 1]
+        ]
+
+    def _paths(self, name_ids: Iterable[int], stop_at_first: bool) -> List[str]:
+        """Returns sorted paths of nodes bearing given names"""
+        nodes = sorted(
+            node
+            for name_id in name_ids
+            for node in self.nodes[
+                self.node_offsets[name_id] : self.node_offsets[name_id + 1]
+            ]
+        )
+        if stop_at_first:
+            nodes = nodes[:1]
+        return [self.tree.path(node) for node in nodes]
+
+    def search_exact(self, name: str, stop_at_first: bool = False) -> List[str]:
+        """Returns paths of nodes named `name`"""
+        _name = self._encode(name)
+        name_id = self._lower_bound(_name)
+        if name_id < len(self) and self._name(name_id) == _name:
+            return self._paths([name_id], stop_at_first)
+        return []
+
+    def search_prefix(self, prefix: str, stop_at_first: bool = False) -> List[str]:
+        """Returns paths of nodes whose name starts with `prefix`"""
+        _prefix = self._encode(prefix)
+        name_ids = []
+        for name_id in range(self._lower_bound(_prefix), len(self)):
+            if not self._name(name_id).startswith(_prefix):
+                break
+            name_ids.append(name_id)
+        return self._paths(name_ids, stop_at_first)
+
+    def search_substring(
+        self, substring: str, stop_at_first: bool = False
+    ) -> List[str]:
+        """Returns paths of nodes whose name contains `substring`"""
+        _substring = self._encode(substring)
+        if b"\0" in _substring:
+            return []
+        if len(_substring) < 3:
+            # Searches the name table directly, like `CompactFS.iter_substring`
+            name_ids = []
+            position = self.names.find(_substring)
+            while position != -1:
+                name_id = bisect_right(self.name_offsets, position) - 1
+                name_ids.append(name_id)
+                position = self.names.find(_substring, self.name_offsets[name_id + 1])
+            return self._paths(name_ids, stop_at_first)
+        candidates = min(
+            (self._postings(_substring[i : i + 3]) for i in range(len(_substring) - 2)),
+            key=len,
+        )
+        return self._paths(
+            (name_id for name_id in candidates if _substring in self._name(name_id)),
+            stop_at_first,
+        )
+
+
+@dataclass
+class ScanFilter:
+    """Declarative filter for file system scans (see `FSscan`), replacing lambdas. It is called on
+    `os.DirEntry` objects and only uses information from the directory listing (no `stat` call),
+    except when size or mtime bounds are set. Entries that don't pass the filter are neither
+    listed nor explored.
+
+    Rules are applied in this order:
+     - entries whose name matches any `exclude` glob or `exclude_regex` are rejected
+     - directories are accepted if `directories` is True
+     - files (other entries are rejected) are accepted if `files` is True and they match every
+       other rule: `extensions` (case insensitive, eg: ``'.txt'``), `include` globs or
+       `include_regex` (if any is given, at least one must match the name) and size (bytes) or
+       mtime (timestamp) bounds
+
+    Globs are case sensitive (see `fnmatch.fnmatchcase`), regexes match with `re.Pattern.match`.
+    Serialisable with `to_dict`/`from_dict`.
+
+    `prune`: gitignore-style patterns (see `PruneRules`, without default patterns) matched on paths
+    relative to the scan root; they are applied by the scanning engine before any other rule.
+    """
+
+    directories: bool = True
+    files: bool = True
+    extensions: Optional[List[str]] = None
+    include: List[str] = field(default_factory=list)
+    include_regex: List[str] = field(default_factory=list)
+    exclude: List[str] = field(default_factory=list)
+    exclude_regex: List[str] = field(default_factory=list)
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+    min_mtime: Optional[float] = None
+    max_mtime: Optional[float] = None
+    prune: List[str] = field(default_factory=list)
+
+    # Legacy filters (lambda strings) that older CachedFS backups may contain
+    LEGACY_FILTERS: ClassVar[Dict[str, Dict[str, Any]]] = {
+        "lambda x: x.is_dir() or x.is_file()": {},
+        "lambda x: x.is_dir()": {"files": False},
+        "lambda x: x.is_file()": {"directories": False},
+    }
+
+    def __post_init__(self) -> None:
+        def combine(globs: List[str], regexes: List[str]) -> Optional[re.Pattern]:
+            patterns = [fnmatch.translate(g) for g in globs] + [
+                f"(?:{r})" for r in regexes
+            ]
+            return re.compile("|".join(patterns)) if patterns else None
+
+        self._exclude = combine(self.exclude, self.exclude_regex)
+        self._include = combine(self.include, self.include_regex)
+        self._extensions = (
+            None
+            if self.extensions is None
+            else {
+                (e if e.startswith(".") else "." + e).lower() for e in self.extensions
+            }
+        )
+        self._needs_stat = any(
+            bound is not None
+            for bound in (self.min_size, self.max_size, self.min_mtime, self.max_mtime)
+        )
+        self.prune_rules = (
+            PruneRules(self.prune, defaults=False) if self.prune else None
+        )
+
+    def __call__(self, entry: os.DirEntry) -> bool:
+        name = entry.name
+        if self._exclude and self._exclude.match(name):
+            return False
+        if entry.is_dir():
+            return self.directories
+        if not (self.files and entry.is_file()):
+            return False
+        if (
+            self._extensions is not None
+            and os.path.splitext(name)[1].lower() not in self._extensions
+        ):
+            return False
+        if self._include and not self._include.match(name):
+            return False
+        if self._needs_stat:
+            stat = entry.stat()
+            if (self.min_size is not None and stat.st_size < self.min_size) or (
+                self.max_size is not None and self.max_size < stat.st_size
+            ):
+                return False
+            if (self.min_mtime is not None and stat.st_mtime < self.min_mtime) or (
+                self.max_mtime is not None and self.max_mtime < stat.st_mtime
+            ):
+                return False
+        return True
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns a JSON-serialisable representation"""
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, d: Union[str, Dict[str, Any]]) -> "ScanFilter":
+        """Builds from `to_dict` output. Also accepts legacy filters (lambda strings) from older
+        CachedFS backups, without evaluating them."""
+        if isinstance(d, str):
+            if d not in cls.LEGACY_FILTERS:
+                raise ValueError(f"Couldn't parse filter '{d}'")
+            return cls(**cls.LEGACY_FILTERS[d])
+        return cls(**d)
+
+
+class Inotify:
+    """Minimal binding to Linux's inotify API (see `man 7 inotify`), using ctypes"""
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+    def __init__(self) -> None:
+        _os = Os()
+        assertTrue(
+            _os.linux or _os.wsl, "inotify is only available on Linux, not {}", _os
+        )
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._check(self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+
+    @staticmethod
+    def _check(result: int) -> int:
+        """Raises OSError if `result` signals a failure"""
+        if result < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return result
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """Watches given path for given events; returns watch descriptor"""
+        return self._check(
+            self._libc.inotify_add_watch(
+                self.fd, os.fsencode(path), ctypes.c_uint32(mask)
+            )
+        )
+
+    def rm_watch(self, watch_descriptor: int) -> None:
+        """Stops watching; errors (eg: already removed watch) are ignored"""
+        self._libc.inotify_rm_watch(self.fd, watch_descriptor)
+
+    def read_events(self, timeout: float) -> List[Tuple[int, int, int, str]]:
+        """Returns list of (<watch descriptor>, <mask>, <cookie>, <name>) events; waits up to
+        `timeout` seconds for events to be available"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 20)
+        except BlockingIOError:
+            return []
+        events = []
+        position = 0
+        while position < len(data):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, position)
+            position += self.EVENT_HEADER.size
+            name = os.fsdecode(data[position : position + length].rstrip(b"\0"))
+            position += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self) -> None:
+        """Releases inotify instance (and all its watches)"""
+        os.close(self.fd)
 
 
 class CachedFS:
@@ -56,16 +1396,65 @@ class CachedFS:
 
     Features :
      - Possiblity to backup to/load from JSON file
-     - cache directories, files, or both
+     - cache directories, files, or both, with optional additional filtering (see `ScanFilter`)
+     - fast multithreaded scanning (see `FSscan`); `workers` sets the thread count
+     - incremental updates: only directories modified since last update are listed again
+     - compact in-memory representation (see `CompactFS`), recommended for large trees
+     - optional name index (see `NameIndex`) for fast string searches, rebuilt on each update
+     - compact binary snapshot files, loaded lazily (see `backup_to_snapshot`)
+     - optional per-entry metadata (size, mtime, inode, device) enabling aggregate queries like
+       `total_size` or `largest_files` without accessing the file system; implies compact
+       representation, and is not saved in JSON backups (only in binary snapshots)
+     - watch mode (Linux only): stays in sync with the file system without calling `update`,
+       see `watch`
     """
 
+    WATCH_MASK = (
+        Inotify.IN_CREATE
+        | Inotify.IN_DELETE
+        | Inotify.IN_MOVED_FROM
+        | Inotify.IN_MOVED_TO
+        | Inotify.IN_ONLYDIR
+    )
+    # Additional events for filters with size/mtime bounds: files may start or stop passing
+    # them when written to or touched
+    STAT_WATCH_MASK = Inotify.IN_CLOSE_WRITE | Inotify.IN_ATTRIB
+
+    SNAPSHOT_SUFFIX = ".fsdb"
+    SNAPSHOT_MAGIC = b"DRSFSDB1"
+    SNAPSHOT_COMPRESSIONS = {None: 0, "gzip": 1, "zstd": 2}
+
     def __init__(
         self,
         root: Path,
         directories: bool = True,
         files: bool = True,
         backup_fs: Optional[dict] = None,
+        workers: Optional[int] = None,
+        compact: bool = False,
+        index: bool = False,
+        scan_filter: Optional[ScanFilter] = None,
+        metadata: bool = False,
     ) -> None:
+        """`directories`, `files`: whether to cache directories, files, or both; ignored if
+        `scan_filter` is given."""
+        self.workers = workers
+        self.compact = compact or metadata
+        self.with_metadata = metadata
+        self.use_index = index
+        self._index: Optional[NameIndex] = None
+        self._index_outdated = False
+        self._lock = threading.RLock()
+        self._inotify: Optional[Inotify] = None
+        self._watch_thread: Optional[threading.Thread] = None
+        self._watch_stop = threading.Event()
+        self._watched: Dict[int, str] = {}  # <watch descriptor> -> <relative path>
+        self._watch_descriptors: Dict[str, int] = {}  # reverse mapping
+        self.fs: Union[dict, CompactFS]
+        # Directory signatures and digests of non-compact representation (see `signatures`,
+        # `digests`); digests are None when outdated
+        self._signatures: Dict[str, DirSignature] = {}
+        self._digests: Optional[Dict[str, bytes]] = None
         if backup_fs:
             self.root = Path(backup_fs["root"])
             assertTrue(
@@ -79,41 +1468,396 @@ class CachedFS:
                 "It seems root='{}' is no longer a valid directory !",
                 self.root,
             )
-            self.filter_text = backup_fs["filter"]
-            self.filter = eval(backup_fs["filter"])  # nosec B307
-            self.fs = backup_fs["fs"]
+            self.filter = ScanFilter.from_dict(backup_fs["filter"])
+            # Backups made by older versions don't have signatures => first update is full
+            signatures: Dict[str, DirSignature] = {
+                k: tuple(v)  # type: ignore[misc]
+                for k, v in backup_fs.get("signatures", {}).items()
+            }
+            if isinstance(backup_fs["fs"], CompactFS):
+                self.compact = True
+                self.with_metadata = self.with_metadata or backup_fs["fs"].has_metadata
+                self.fs = backup_fs["fs"]
+            elif self.compact:
+                self.fs = CompactFS.from_dict(backup_fs["fs"], signatures or None)
+            else:
+                self.fs = backup_fs["fs"]
+                self._signatures = signatures
+                if "digests" in backup_fs:
+                    self._digests = {
+                        k: bytes.fromhex(v) for k, v in backup_fs["digests"].items()
+                    }
+            self.update_index()
 
         else:
+            self.filter = scan_filter or ScanFilter(
+                directories=directories, files=files
+            )
             assertTrue(
-                files or directories,
+                self.filter.files or self.filter.directories,
                 "CachedFS cannot be instantiated with directories=files=False.",
             )
             assertTrue(root.is_dir(), "root='{}' is not a valid directory", root)
             self.root = root.resolve()
-            condition = " or ".join(
-                [
-                    x
-                    for x in [
-                        "x.is_dir()" if directories else None,
-                        "x.is_file()" if files else None,
-                    ]
-                    if x is not None
-                ]
-            )
-            self.filter_text = f"lambda x: {condition}"
-            try:
-                self.filter = eval(self.filter_text)  # nosec B307
-            except ValueError as e:
-                raise ValueError(f"Couldn't parse filter '{self.filter_text}'") from e
             self.update()
 
+    @property
+    def signatures(self) -> Dict[str, DirSignature]:
+        """Signature of each directory at last update (see `directory_signature`), with paths
+        relative to root. In compact representation, signatures are stored in the tree and
+        this dictionnary is built on each access."""
+        if isinstance(self.fs, CompactFS):
+            return self.fs.signatures() if self.fs.has_signatures else {}
+        return self._signatures
+
+    @property
+    def digests(self) -> Dict[str, bytes]:
+        """Digest of each directory (see `tree_digests`), with paths like `tree_digests` on
+        `as_dict` output (with metadata, if available). In compact representation, digests are
+        computed on update, stored in the tree and this dictionnary is built on each access;
+        otherwise they are computed on first access after an update."""
+        if isinstance(self.fs, CompactFS):
+            return self.fs.path_digests()
+        if self._digests is None:
+            self._digests = tree_digests(self.fs)
+        return self._digests
+
     @timer
-    def update(self) -> None:
-        """Updates internal DB"""
-        self.fs = FSindex(self.root, self.filter)
+    def update(self, incremental: bool = False) -> None:
+        """Updates internal DB
+
+        `incremental`: if True, only directories whose signature (see `directory_signature`)
+        changed since last update are listed again; other directories cost one `stat` call each. Falls back
+        to a full update if no signatures are available. Note: files in unchanged directories
+        are not checked again against the filter's size/mtime bounds.
+        """
+        with self._lock:
+            self._update(incremental)
+            if self._inotify is not None:
+                self._sync_watches()
+
+    def _update(self, incremental: bool) -> None:
+        """See `update`"""
+        previous = self.fs if incremental else None
+        if self.compact:
+            self.fs = _scan_compact(
+                self.root,
+                self.filter,
+                self.workers,
+                previous=previous if isinstance(previous, CompactFS) else None,
+                metadata=self.with_metadata,
+            )
+        elif isinstance(previous, dict) and self._signatures:
+            self.fs, self._signatures = _scan_tree(
+                self.root,
+                self.filter,
+                self.workers,
+                previous_fs=previous,
+                previous_signatures=self._signatures,
+            )
+            self._digests = None
+        else:
+            self.fs, self._signatures = _scan_tree(
+                self.root, self.filter, self.workers, track_signatures=True
+            )
+            self._digests = None
+        self.update_index()
+
+    @property
+    def index(self) -> Optional[NameIndex]:
+        """Name index, if enabled (rebuilt on first use after changes made in watch mode)"""
+        if self._index_outdated:
+            self.update_index()
+        return self._index
+
+    def update_index(self) -> None:
+        """(Re)builds name index, if enabled"""
+        self._index_outdated = False
+        if not self.use_index:
+            return
+        with self._lock:
+            self._index = NameIndex(
+                self.fs
+                if isinstance(self.fs, CompactFS)
+                else CompactFS.from_dict(self.fs)
+            )
+
+    def watch(self) -> None:
+        """Starts watch mode (Linux only, requires non-compact representation): a background
+        thread receives inotify events for all cached directories and patches internal DB on
+        creation, deletion and move of entries, so calling `update` is no longer needed. If
+        events are lost (inotify queue overflow), an incremental update is performed. If the
+        filter has size or mtime bounds, files are also checked again against it when written to
+        or when their attributes change.
+
+        Searches are thread-safe, except `iter_search` which may fail if internal DB is patched
+        while iterating. Stop with `unwatch`.
+
+        Note: the number of directories that can be watched is limited by system setting
+        `fs.inotify.max_user_watches`.
+        """
+        assertTrue(
+            not isinstance(self.fs, CompactFS),
+            "Watch mode requires non-compact representation",
+        )
+        if self._inotify is not None:
+            return
+        with self._lock:
+            self._inotify = Inotify()
+            self._sync_watches()
+        self._watch_stop.clear()
+        self._watch_thread = threading.Thread(
+            target=self._watch_loop, name="CachedFS.watch", daemon=True
+        )
+        self._watch_thread.start()
+
+    def unwatch(self) -> None:
+        """Stops watch mode"""
+        if self._inotify is None:
+            return
+        self._watch_stop.set()
+        if self._watch_thread is not None:
+            self._watch_thread.join()
+        with self._lock:
+            self._inotify.close()
+            self._inotify = None
+            self._watched.clear()
+            self._watch_descriptors.clear()
+
+    def _watch_loop(self) -> None:
+        """Watch mode thread: receives and applies inotify events"""
+        while not self._watch_stop.is_set():
+            events = self._inotify.read_events(timeout=0.5)  # type: ignore[union-attr]
+            if not events:
+                continue
+            with self._lock:
+                try:
+                    self._apply_events(events)
+                except Exception as e:
+                    LOG.warning("CachedFS.watch: error while applying events: %s", e)
+                    self._update(incremental=True)
+                    self._sync_watches()
+                self._index_outdated = self.use_index
+
+    def _content_at(self, rel_path: str) -> Optional[dict]:
+        """Returns content of directory at given path (relative to root) in internal DB"""
+        content = next(iter(self.fs.values()))  # type: ignore[union-attr]
+        for part in rel_path.split("/") if rel_path else []:
+            if not content:
+                return None
+            content = content.get(part)
+        return content
+
+    def _add_watch(self, rel_path: str) -> None:
+        """Watches directory at given path (relative to root)"""
+        try:
+            wd = self._inotify.add_watch(  # type: ignore[union-attr]
+                str(self.root / rel_path),
+                self.WATCH_MASK
+                | (self.STAT_WATCH_MASK if self.filter._needs_stat else 0),
+            )
+        except OSError as e:
+            LOG.warning("CachedFS.watch: couldn't watch '%s': %s", rel_path, e)
+            return
+        self._watched[wd] = rel_path
+        self._watch_descriptors[rel_path] = wd
+
+    def _add_watches(self, content: Optional[dict], rel_path: str) -> None:
+        """Watches directory at given path (relative to root) and its subdirectories"""
+        stack = [(content, rel_path)]
+        while stack:
+            _content, _rel_path = stack.pop()
+            self._add_watch(_rel_path)
+            for name, children in (_content or {}).items():
+                if children is not None:
+                    stack.append(
+                        (children, f"{_rel_path}/{name}" if _rel_path else name)
+                    )
+
+    def _remove_watches(self, rel_path: str) -> None:
+        """Stops watching directory at given path (relative to root) and its subdirectories"""
+        prefix = rel_path + "/"
+        for _rel_path in [
+            p for p in self._watch_descriptors if p == rel_path or p.startswith(prefix)
+        ]:
+            wd = self._watch_descriptors.pop(_rel_path)
+            self._watched.pop(wd, None)
+            self._inotify.rm_watch(wd)  # type: ignore[union-attr]
+
+    def _move_watches(self, old_rel_path: str, new_rel_path: str) -> None:
+        """Updates watch mapping after a directory was moved"""
+        prefix = old_rel_path + "/"
+        for _rel_path in [
+            p
+            for p in self._watch_descriptors
+            if p == old_rel_path or p.startswith(prefix)
+        ]:
+            wd = self._watch_descriptors.pop(_rel_path)
+            moved_rel_path = new_rel_path + _rel_path[len(old_rel_path) :]
+            self._watched[wd] = moved_rel_path
+            self._watch_descriptors[moved_rel_path] = wd
+
+    def _sync_watches(self) -> None:
+        """Makes watches match directories in internal DB"""
+        self._remove_watches("")
+        self._add_watches(self._content_at(""), "")
+
+    def _accepts(self, path: Path, rel_path: str) -> bool:
+        """Returns True if entry at `path` (`rel_path` relative to root) passes filter"""
+        prune = self.filter.prune_rules
+        if prune is not None and prune.excludes(rel_path, path.is_dir()):
+            return False
+        # ScanFilter only uses attributes `os.DirEntry` has in common with `Path`
+        return self.filter(path)  # type: ignore[arg-type]
+
+    def _apply_events(self, events: List[Tuple[int, int, int, str]]) -> None:
+        """Patches internal DB according to given inotify events"""
+        self._digests = None
+        overflow = False
+        # Entries moved from a watched directory, by cookie, waiting for matching IN_MOVED_TO
+        moved: Dict[int, Tuple[Optional[dict], str]] = {}
+        for wd, mask, cookie, name in events:
+            if mask & Inotify.IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            rel_path = self._watched.get(wd)
+            if rel_path is None:
+                continue
+            if mask & Inotify.IN_IGNORED:
+                # Watch was removed (directory deleted or unmounted)
+                del self._watched[wd]
+                if self._watch_descriptors.get(rel_path) == wd:
+                    del self._watch_descriptors[rel_path]
+                continue
+            parent = self._content_at(rel_path)
+            if parent is None:
+                continue
+            child_rel_path = f"{rel_path}/{name}" if rel_path else name
+
+            if mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                if name not in parent:
+                    continue
+                content = parent.pop(name)
+                if content is not None:
+                    if mask & Inotify.IN_MOVED_FROM:
+                        moved[cookie] = (content, child_rel_path)
+                    else:
+                        self._remove_watches(child_rel_path)
+
+            elif mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                path = self.root / child_rel_path
+                if not self._accepts(path, child_rel_path):
+                    if cookie in moved:
+                        self._remove_watches(moved.pop(cookie)[1])
+                    continue
+                if mask & Inotify.IN_MOVED_TO and cookie in moved:
+                    content, old_rel_path = moved.pop(cookie)
+                    parent[name] = content
+                    self._move_watches(old_rel_path, child_rel_path)
+                elif mask & Inotify.IN_ISDIR:
+                    # Watch first so that no change is missed during scan
+                    self._add_watch(child_rel_path)
+                    try:
+                        content = next(
+                            iter(
+                                _scan_tree(
+                                    path,
+                                    self.filter,
+                                    self.workers,
+                                    prune_base=child_rel_path + "/",
+                                )[0].values()
+                            )
+                        )
+                    except Exception as e:
+                        LOG.warning(
+                            "CachedFS.watch: couldn't scan '%s': %s", child_rel_path, e
+                        )
+                        content = {}
+                    parent[name] = content
+                    for _name, children in (content or {}).items():
+                        if children is not None:
+                            self._add_watches(children, f"{child_rel_path}/{_name}")
+                else:
+                    parent[name] = None
+
+            elif mask & self.STAT_WATCH_MASK:
+                # File written to or touched (events about the directory itself have no name)
+                if not name or mask & Inotify.IN_ISDIR:
+                    continue
+                try:
+                    accepted = self._accepts(self.root / child_rel_path, child_rel_path)
+                except OSError:
+                    continue  # Deleted since, an IN_DELETE event follows
+                if accepted and name not in parent:
+                    parent[name] = None
+                elif not accepted and name in parent and parent[name] is None:
+                    del parent[name]
+
+        # Directories moved out of watched directories
+        for _, old_rel_path in moved.values():
+            self._remove_watches(old_rel_path)
+
+        if overflow:
+            LOG.info("CachedFS.watch: inotify queue overflow, updating")
+            self._update(incremental=True)
+            self._sync_watches()
+
+    def as_dict(self, metadata: bool = False) -> dict:
+        """Returns internal DB as a `FSindex`-like nested dictionnary. If `metadata` is True, files
+        have their metadata as value instead of None (requires metadata)."""
+        if isinstance(self.fs, CompactFS):
+            return self.fs.to_dict(metadata)
+        assertTrue(not metadata, "No metadata available")
+        return self.fs
+
+    def diff(self, previous: "CachedFS") -> "TreeDiff":
+        """Returns changes from `previous` (eg: an older backup of the same tree) to this one,
+        see `diff_trees`. If both have metadata, modified and moved files are also detected.
+        """
+        with_metadata = all(
+            isinstance(cfs.fs, CompactFS) and cfs.fs.has_metadata
+            for cfs in (self, previous)
+        )
+        with self._lock, previous._lock:
+            return _diff_engine(
+                previous._diff_accessor(with_metadata),
+                self._diff_accessor(with_metadata),
+            )
+
+    def _diff_accessor(self, metadata: bool) -> "TreeAccessor":
+        """Returns accessor on internal DB for `_diff_engine`, without conversion: only
+        directories with different digests are visited. If `metadata` is True, files have their
+        metadata as value (requires metadata)."""
+        if not isinstance(self.fs, CompactFS):
+            return _dict_accessor(self.fs, self.digests)
+
+        tree = self.fs
+
+        def entries(node: Optional[int]) -> Dict[str, Tuple[Any, bool, Any]]:
+            if node is None:
+                return {tree.name(0): (0, True, None)}
+            return {
+                tree.name(child): (
+                    child,
+                    tree.is_dir(child),
+                    tree.metadata(child) if metadata else None,
+                )
+                for child in tree.children(node)
+            }
+
+        # The top-level directory (None) is the dictionnary containing the root
+        return (
+            None,
+            entries,
+            lambda node, _: tree.top_digest() if node is None else tree.digest(node),
+        )
 
     def __contains__(self, pattern: str) -> bool:
         """Implements `<pattern:str> in <_:CachedFS>` operation"""
+        if self.index and not REGEX_SPECIAL_CHARACTERS.intersection(pattern):
+            # Literal pattern: equivalent to a prefix search
+            return 0 < len(self.index.search_prefix(pattern, stop_at_first=True))
+
         _pattern = re.compile(pattern, flags=re.IGNORECASE)
 
         return 0 < len(self.search(search_for=_pattern, stop_at_first=True))
@@ -131,6 +1875,28 @@ class CachedFS:
         `stop_at_first`: returns at most one matching item.
         """
 
+        if isinstance(search_for, str) and self.index:
+            return self.index.search_substring(search_for, stop_at_first)
+
+        with self._lock:
+            matches = self.iter_search(search_for)
+            return list(islice(matches, 1) if stop_at_first else matches)
+
+    def iter_search(
+        self, search_for: Union[str, re.Pattern, Callable]
+    ) -> Iterator[str]:
+        """Lazy variant of `search`: yields matching paths (in the same order) as they are found,
+        so callers can stop early or process matches in a pipeline. Tree traversal uses an
+        explicit stack, so it is not limited by Python's recursion limit on deep trees.
+        """
+        if isinstance(search_for, str):
+            if self.index:
+                yield from self.index.search_substring(search_for)
+                return
+            if isinstance(self.fs, CompactFS):
+                yield from self.fs.iter_substring(search_for)
+                return
+
         if callable(search_for):
             _search_for = search_for
         if isinstance(search_for, re.Pattern):
@@ -139,38 +1905,147 @@ class CachedFS:
             search_for_lower = search_for.lower()
             _search_for = lambda x: search_for_lower in x.lower()  # type: ignore[union-attr]
 
-        def combine_paths(x: Optional[str], y: str) -> str:
-            return f"{x}/{y}" if x else y
+        for name, parent_path in self._walk():
+            if _search_for(name):
+                yield f"{parent_path}/{name}" if parent_path else name
 
-        def search_recursive(FSDB: dict, path_prefix: str = ""):
-            matches = []
-            # print(f"search_recursive: from '{path_prefix}'")
-            try:
-                for item, children in FSDB.items():
-                    if _search_for(item):
-                        # print(f"Positive: '{item}'")
-                        matches.append(combine_paths(path_prefix, item))
-                        if stop_at_first:
-                            return matches
-                    if children:
-                        matches.extend(
-                            search_recursive(children, combine_paths(path_prefix, item))
+    def _walk(self) -> Iterator[Tuple[str, str]]:
+        """Iterates over (<name>, <parent path>) for each item, in search order"""
+        if isinstance(self.fs, CompactFS):
+            yield from self.fs.iter_entries()
+            return
+
+        # Explicit stack of (<path>, <iterator over its content>) to preserve order
+        stack = [("", iter(self.fs.items()))]
+        while stack:
+            parent_path, items = stack[-1]
+            for name, children in items:
+                yield name, parent_path
+                if children:
+                    stack.append(
+                        (
+                            f"{parent_path}/{name}" if parent_path else name,
+                            iter(children.items()),
                         )
-                    if stop_at_first and matches:
-                        return matches
-            except Exception as e:
-                print(
-                    f"search_recursive: something went wrong at '{path_prefix}'. Error:\n{e}"
-                )
-                raise
+                    )
+                    break
+            else:
+                stack.pop()
 
-            return matches
+    @timer
+    def search_many(
+        self, patterns: Iterable[Union[str, re.Pattern, Callable]]
+    ) -> Dict[Any, List[str]]:
+        """Performs many searches (see `search` for accepted patterns) in a single pass over
+        internal FileSystem representation. Returns matches for each pattern.
 
-        return search_recursive(self.fs)
+        String patterns are not tested one by one: they are grouped by length, and each name's
+        substrings of these lengths are looked up in the corresponding group, so the cost doesn't
+        depend on the number of string patterns.
+        """
+        matches: Dict[Any, List[str]] = {}
+        # Maps <length> -> <lower-cased pattern> -> <original patterns>
+        string_patterns: Dict[int, Dict[str, List[str]]] = {}
+        other_patterns: List[Tuple[Any, Callable]] = []
+        for pattern in patterns:
+            if pattern in matches:
+                continue
+            matches[pattern] = []
+            if isinstance(pattern, str):
+                pattern_lower = pattern.lower()
+                string_patterns.setdefault(len(pattern_lower), {}).setdefault(
+                    pattern_lower, []
+                ).append(pattern)
+            elif isinstance(pattern, re.Pattern):
+                other_patterns.append((pattern, pattern.match))
+            else:
+                other_patterns.append((pattern, pattern))
+
+        with self._lock:
+            for name, parent_path in self._walk():
+                path = None
+                found = set()
+                if string_patterns:
+                    name_lower = name.lower()
+                    for length, group in string_patterns.items():
+                        for i in range(len(name_lower) - length + 1):
+                            substring = name_lower[i : i + length]
+                            if substring in group:
+                                found.add(substring)
+                    for substring in found:
+                        path = path or (
+                            f"{parent_path}/{name}" if parent_path else name
+                        )
+                        for pattern in string_patterns[len(substring)][substring]:
+                            matches[pattern].append(path)
+                for pattern, predicate in other_patterns:
+                    if predicate(name):
+                        path = path or (
+                            f"{parent_path}/{name}" if parent_path else name
+                        )
+                        matches[pattern].append(path)
+
+        return matches
+
+    def search_exact(self, name: str, stop_at_first: bool = False) -> List[str]:
+        """Returns paths of items named `name` (case insensitive)"""
+        if self.index:
+            return self.index.search_exact(name, stop_at_first)
+        name_lower = name.lower()
+        return self.search(lambda x: x.lower() == name_lower, stop_at_first)
+
+    def search_prefix(self, prefix: str, stop_at_first: bool = False) -> List[str]:
+        """Returns paths of items whose name starts with `prefix` (case insensitive)"""
+        if self.index:
+            return self.index.search_prefix(prefix, stop_at_first)
+        prefix_lower = prefix.lower()
+        return self.search(lambda x: x.lower().startswith(prefix_lower), stop_at_first)
+
+    def _metadata_tree(self, path: Optional[str]) -> Tuple[CompactFS, int]:
+        """Returns (<tree>, <node at `path` (root if None)>) for metadata queries"""
+        assertTrue(
+            isinstance(self.fs, CompactFS) and self.fs.has_metadata,
+            "No metadata available: CachedFS must be created with metadata=True and updated",
+        )
+        tree: CompactFS = self.fs  # type: ignore[assignment]
+        node = 0 if path is None else tree.find(path)
+        assertTrue(node is not None, "Path '{}' not found", path)
+        return tree, node  # type: ignore[return-value]
+
+    def total_size(self, path: Optional[str] = None) -> int:
+        """Returns total size (bytes) of files under `path` (formatted like `search` results;
+        default: root). Requires metadata."""
+        tree, node = self._metadata_tree(path)
+        return tree.subtree_size(node)
+
+    def largest_files(
+        self, n: int = 10, path: Optional[str] = None
+    ) -> List[Tuple[str, int]]:
+        """Returns (<path>, <size (bytes)>) of the `n` largest files under `path` (formatted like
+        `search` results; default: root), largest first. Requires metadata."""
+        tree, node = self._metadata_tree(path)
+        return tree.top_files(n, "sizes", node)
+
+    def newest_files(
+        self, n: int = 10, path: Optional[str] = None
+    ) -> List[Tuple[str, int]]:
+        """Returns (<path>, <mtime (ns)>) of the `n` most recently modified files under `path`
+        (formatted like `search` results; default: root), newest first. Requires metadata.
+        """
+        tree, node = self._metadata_tree(path)
+        return tree.top_files(n, "mtimes", node)
 
     def as_json(self) -> str:
         """Dumps CachedFS as json-formatted string"""
-        data = {"root": str(self.root), "fs": self.fs, "filter": self.filter_text}
+        data = {
+            "root": str(self.root),
+            "fs": self.as_dict(),
+            "filter": self.filter.to_dict(),
+            "signatures": self.signatures,
+        }
+        if not self.with_metadata:
+            # Otherwise digests cover metadata, which isn't saved
+            data["digests"] = {k: v.hex() for k, v in self.digests.items()}
         return json.dumps(data, indent=2)
 
     def backup_to_file(self, backup_file: Path) -> None:
@@ -183,7 +2058,9 @@ class CachedFS:
         backup_file.write_text(self.as_json(), encoding="utf8")
 
     @classmethod
-    def from_file(cls, backup_file: Path, root: Path):
+    def from_file(
+        cls, backup_file: Path, root: Path, compact: bool = False, index: bool = False
+    ):
         """Loads CachedFS from json-formatted string produced by CachedFS.backup_to_file() function.
         Note: `root` is required to verify the intended root matches root in cache file.
         """
@@ -193,7 +2070,126 @@ class CachedFS:
             backup_file.suffix.lower(),
         )
         backup = json.loads(backup_file.read_text(encoding="utf8"))
-        return CachedFS(root=root, backup_fs=backup)
+        return CachedFS(root=root, backup_fs=backup, compact=compact, index=index)
+
+    def backup_to_snapshot(
+        self, snapshot_file: Path, compression: Optional[str] = None
+    ) -> None:
+        """Dumps CachedFS to a binary snapshot file, which is much smaller and faster to load
+        than a JSON backup. See `from_snapshot`.
+
+        `compression`: None (default; allows lazy loading), 'gzip' or 'zstd' (requires package
+        `zstandard`)
+
+        File layout: magic bytes, compression code (1 byte, then padding to 8 bytes), header
+        size (8 bytes, little-endian), JSON header, then payload (possibly compressed):
+        `CompactFS` tables (see `CompactFS.to_buffers`), directory signatures included.
+        """
+        assertTrue(
+            snapshot_file.suffix.lower() == self.SNAPSHOT_SUFFIX,
+            "Unexpected suffix '{}'",
+            snapshot_file.suffix.lower(),
+        )
+        assertTrue(
+            compression in self.SNAPSHOT_COMPRESSIONS,
+            "Unknown compression '{}'",
+            compression,
+        )
+        assertTrue(
+            compression != "zstd" or zstandard is not None,
+            "Compression 'zstd' requires package 'zstandard'",
+        )
+        tree = (
+            self.fs
+            if isinstance(self.fs, CompactFS)
+            else CompactFS.from_dict(self.fs, self._signatures or None)
+        )
+        header = json.dumps(
+            {
+                "root": str(self.root),
+                "filter": self.filter.to_dict(),
+                "byteorder": sys.byteorder,
+                "layout": tree.layout(),
+            }
+        ).encode("utf8")
+        header += b" " * (-len(header) % 8)
+
+        # Written to a temporary file first: `snapshot_file` may be memory-mapped by a CachedFS
+        # loaded from it (see `from_snapshot`), which must not see it change
+        tmp_file = snapshot_file.with_name(snapshot_file.name + ".tmp")
+        try:
+            with tmp_file.open("wb") as f:
+                f.write(self.SNAPSHOT_MAGIC)
+                f.write(struct.pack("<B7x", self.SNAPSHOT_COMPRESSIONS[compression]))
+                f.write(struct.pack("<Q", len(header)))
+                f.write(header)
+                if compression == "gzip":
+                    with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6) as g:
+                        for buffer in tree.to_buffers():
+                            g.write(buffer)
+                elif compression == "zstd":
+                    compressor = zstandard.ZstdCompressor().compressobj()
+                    for buffer in tree.to_buffers():
+                        f.write(compressor.compress(buffer))
+                    f.write(compressor.flush())
+                else:
+                    for buffer in tree.to_buffers():
+                        f.write(buffer)
+            os.replace(tmp_file, snapshot_file)
+        except BaseException:
+            if tmp_file.exists():
+                tmp_file.unlink()
+            raise
+
+    @classmethod
+    def from_snapshot(cls, snapshot_file: Path, root: Path, index: bool = False):
+        """Loads CachedFS from binary snapshot produced by CachedFS.backup_to_snapshot() function.
+        Uncompressed snapshots are memory-mapped, so loading time doesn't depend on tree size; the
+        file must then not be modified while the returned CachedFS is in use (`backup_to_snapshot`
+        replaces the file instead, so saving to the same file is safe). Resulting CachedFS
+        uses the compact representation (see `CompactFS`).
+        Note: `root` is required to verify the intended root matches root in cache file.
+        """
+        assertTrue(
+            snapshot_file.suffix.lower() == cls.SNAPSHOT_SUFFIX,
+            "Unexpected suffix '{}'",
+            snapshot_file.suffix.lower(),
+        )
+        with snapshot_file.open("rb") as f:
+            assertTrue(
+                f.read(len(cls.SNAPSHOT_MAGIC)) == cls.SNAPSHOT_MAGIC,
+                "'{}' is not a CachedFS snapshot file",
+                snapshot_file,
+            )
+            (compression_code,) = struct.unpack("<B7x", f.read(8))
+            (header_size,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_size).decode("utf8"))
+            payload_start = f.tell()
+            if compression_code == cls.SNAPSHOT_COMPRESSIONS[None]:
+                payload = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))[
+                    payload_start:
+                ]
+            elif compression_code == cls.SNAPSHOT_COMPRESSIONS["gzip"]:
+                payload = memoryview(gzip.decompress(f.read()))
+            elif compression_code == cls.SNAPSHOT_COMPRESSIONS["zstd"]:
+                assertTrue(
+                    zstandard is not None,
+                    "Reading '{}' requires package 'zstandard'",
+                    snapshot_file,
+                )
+                payload = memoryview(
+                    zstandard.ZstdDecompressor().stream_reader(f).read()
+                )
+            else:
+                raise ValueError(f"Unknown compression code {compression_code}")
+
+        tree = CompactFS.from_buffer(
+            payload,
+            header["layout"],
+            byteswap=header["byteorder"] != sys.byteorder,
+        )
+        backup = {"root": header["root"], "filter": header["filter"], "fs": tree}
+        return CachedFS(root=root, backup_fs=backup, index=index)
 
 
 def get_snapshot_file(snapshot_folder: Path, snapshot_filename: str) -> Path:
@@ -222,28 +2218,521 @@ def get_snapshot_file(snapshot_folder: Path, snapshot_filename: str) -> Path:
     return snapshot_file
 
 
+class FederatedFS:
+    """Several `CachedFS` (one per root, eg: one per mount point) searched as one.
+
+    Roots are scanned concurrently, each in its own thread, and refreshed independently (see
+    `update`): a slow root doesn't block the others, and searches run on the latest completed
+    scan of each root. Each member keeps its own name index, rebuilt only when that root is
+    updated; searches query members one after the other and concatenate their results, so they
+    are ordered by root, in given order. Members use the compact representation; watch mode is
+    not supported.
+    """
+
+    def __init__(
+        self,
+        roots: Iterable[Path],
+        index: bool = True,
+        **kwargs: Any,
+    ) -> None:
+        """`index`: whether members maintain a name index (see `NameIndex`)
+
+        `kwargs`: passed to each member `CachedFS` (eg: `scan_filter`, `workers`, `metadata`)
+        """
+        self.use_index = index
+        roots = [Path(root).resolve() for root in roots]
+        assertTrue(0 < len(roots), "FederatedFS needs at least one root")
+        assertTrue(
+            len(set(roots)) == len(roots),
+            "FederatedFS roots must be distinct: {}",
+            roots,
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(roots), thread_name_prefix="FederatedFS"
+        )
+        kwargs.update(compact=True, index=index)
+        futures = {
+            root: self._executor.submit(CachedFS, root, **kwargs) for root in roots
+        }
+        self.members: Dict[Path, CachedFS] = {
+            root: future.result() for root, future in futures.items()
+        }
+
+    @property
+    def roots(self) -> List[Path]:
+        """Roots, in search order"""
+        return list(self.members)
+
+    def update(
+        self,
+        roots: Optional[Iterable[Path]] = None,
+        incremental: bool = False,
+        wait: bool = True,
+    ) -> Dict[Path, Future]:
+        """Updates given roots (default: all), concurrently. Returns a future per root.
+
+        `incremental`: see `CachedFS.update`
+
+        `wait`: if False, returns immediately; searches use the previous state of a root until
+        its update is complete. Otherwise waits for all updates and raises the first error.
+        """
+        _roots = self.roots if roots is None else [Path(r).resolve() for r in roots]
+        for root in _roots:
+            assertTrue(root in self.members, "Unknown root '{}'", root)
+        futures = {
+            root: self._executor.submit(self.members[root].update, incremental)
+            for root in _roots
+        }
+        if wait:
+            for future in futures.values():
+                future.result()
+        return futures
+
+    def close(self) -> None:
+        """Releases update threads; pending updates are completed first"""
+        self._executor.shutdown(wait=True)
+
+    def _trees(self) -> List[Tuple[CompactFS, Optional[NameIndex]]]:
+        """Returns (<tree>, <its name index, if enabled>) of each member, in root order. Members
+        replace their tree and index on update instead of modifying them, so this doesn't wait
+        for ongoing updates."""
+        return [
+            (member.fs, member.index) for member in self.members.values()  # type: ignore[misc]
+        ]
+
+    def __contains__(self, pattern: str) -> bool:
+        """Implements `<pattern:str> in <_:FederatedFS>` operation (see `CachedFS.__contains__`)"""
+        if self.use_index and not REGEX_SPECIAL_CHARACTERS.intersection(pattern):
+            return any(
+                index.search_prefix(pattern, stop_at_first=True)
+                for _, index in self._trees()
+                if index
+            )
+
+        _pattern = re.compile(pattern, flags=re.IGNORECASE)
+        return 0 < len(self.search(search_for=_pattern, stop_at_first=True))
+
+    @timer
+    def search(
+        self, search_for: Union[str, re.Pattern, Callable], stop_at_first: bool = False
+    ) -> List[str]:
+        """Performs a search on all roots; see `CachedFS.search`"""
+        matches: List[str] = []
+        for tree, index in self._trees():
+            if isinstance(search_for, str):
+                if index:
+                    matches += index.search_substring(search_for, stop_at_first)
+                else:
+                    matches += tree.search_substring(search_for, stop_at_first)
+            elif isinstance(search_for, re.Pattern):
+                pattern = search_for
+                matches += tree.search(lambda x: bool(pattern.match(x)), stop_at_first)
+            else:
+                matches += tree.search(search_for, stop_at_first)
+            if stop_at_first and matches:
+                break
+        return matches
+
+
+@dataclass
+class TreeDiff:
+    """Changes between two trees, as returned by `diff_trees`. Paths are joined with '/'
+    (like `CachedFS.search` results). An added/removed directory is reported as a single entry,
+    its content isn't listed."""
+
+    added: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    modified: List[str] = field(default_factory=list)
+    moved: List[Tuple[str, str]] = field(default_factory=list)  # (<old>, <new>)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.modified or self.moved)
+
+
+def _leaf_value(value: Any) -> Any:
+    """Returns file value as digested and compared (see `tree_digests`): paths, like file values
+    of `get_folder_snapshot` trees, depend on the location of the tree so they are ignored
+    """
+    return None if isinstance(value, Path) else value
+
+
+def _directory_digest(entries: Iterable[Tuple[bytes, Optional[bytes], Any]]) -> bytes:
+    """Returns digest of a directory (see `tree_digests`), given (<encoded name>, <digest if
+    subdirectory, else None>, <value if file>) of its entries, sorted by name"""
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for name, digest, value in entries:
+        hasher.update(name + b"\0")
+        if digest is not None:
+            hasher.update(b"D" + digest)
+        else:
+            hasher.update(b"F" + repr(value).encode("utf8", "surrogatepass"))
+        hasher.update(b"\0")
+    return hasher.digest()
+
+
+def tree_digests(tree: dict) -> Dict[str, bytes]:
+    """Returns Merkle-style digests of all directories in `tree`, a nested dictionnary like
+    `FSindex`, `CachedFS.as_dict` or "complex" `get_folder_snapshot` results : a directory's
+    digest covers its entries' names and values (file values, or subdirectory digests), so
+    identical digests mean identical subtrees. File values that are paths are ignored, so that
+    digests don't depend on the location of the tree. Keys are paths relative to `tree`
+    ('' for `tree` itself). Digests can be kept and given to `diff_trees` later, so only the
+    newest tree needs hashing.
+    """
+    digests: Dict[str, bytes] = {}
+    # Post-order traversal with an explicit stack of (<path>, <content>, <children visited>)
+    stack: List[Tuple[str, dict, bool]] = [("", tree, False)]
+    while stack:
+        path, content, visited = stack.pop()
+        if not visited:
+            stack.append((path, content, True))
+            stack.extend(
+                (f"{path}/{name}" if path else name, value, False)
+                for name, value in content.items()
+                if isinstance(value, dict)
+            )
+            continue
+        digests[path] = _directory_digest(
+            (
+                name.encode("utf8", "surrogatepass"),
+                (
+                    digests[f"{path}/{name}" if path else name]
+                    if isinstance(content[name], dict)
+                    else None
+                ),
+                _leaf_value(content[name]),
+            )
+            for name in sorted(content)
+            if name != "__nbfiles__"
+        )
+    return digests
+
+
+# Tree accessor for `_diff_engine`: (<root directory>, <entries>, <digest>), where
+# `entries(<directory>)` returns {<name>: (<entry>, <is directory>, <value if file>)} and
+# `digest(<directory>, <path>)` returns its digest (see `tree_digests`)
+TreeAccessor = Tuple[
+    Any,
+    Callable[[Any], Dict[str, Tuple[Any, bool, Any]]],
+    Callable[[Any, str], bytes],
+]
+
+
+def _dict_accessor(tree: dict, digests: Dict[str, bytes]) -> TreeAccessor:
+    """Returns accessor on a nested dictionnary (see `diff_trees`) with given digests"""
+
+    def entries(content: dict) -> Dict[str, Tuple[Any, bool, Any]]:
+        return {
+            name: (value, isinstance(value, dict), _leaf_value(value))
+            for name, value in content.items()
+            if name != "__nbfiles__"
+        }
+
+    return tree, entries, lambda _, path: digests[path]
+
+
+def diff_trees(
+    old: dict,
+    new: dict,
+    old_digests: Optional[Dict[str, bytes]] = None,
+    new_digests: Optional[Dict[str, bytes]] = None,
+) -> TreeDiff:
+    """Returns changes from tree `old` to tree `new`, nested dictionnaries like `FSindex`,
+    `CachedFS.as_dict` or "complex" `get_folder_snapshot` results (see `tree_digests`).
+
+    Subtrees with identical digests are skipped, so once digests are known the cost scales with
+    the size of the change rather than the size of the trees. Pass previously computed digests
+    as `old_digests`/`new_digests` to avoid recomputing them.
+
+    A file is modified if its value changed, so this requires values describing files, eg: metadata
+    from ``CachedFS.as_dict(metadata=True)``; path values (like in `get_folder_snapshot` trees) are
+    ignored, so changes to such files aren't reported.
+    A removed entry and an added entry are paired as moved if they are the only ones with a given
+    digest (directories) or value (files; None values are ignored).
+    """
+    if old_digests is None:
+        old_digests = tree_digests(old)
+    if new_digests is None:
+        new_digests = tree_digests(new)
+    return _diff_engine(
+        _dict_accessor(old, old_digests), _dict_accessor(new, new_digests)
+    )
+
+
+def _diff_engine(old: TreeAccessor, new: TreeAccessor) -> TreeDiff:
+    """Diff engine behind `diff_trees` and `CachedFS.diff`, working on any tree representation
+    through accessors"""
+    (old_root, old_entries, old_digest), (new_root, new_entries, new_digest) = old, new
+    diff = TreeDiff()
+    # <path> -> (<entry>, <is directory>, <value>)
+    removed: Dict[str, Tuple[Any, bool, Any]] = {}
+    added: Dict[str, Tuple[Any, bool, Any]] = {}
+    stack: List[Tuple[str, Any, Any]] = [("", old_root, new_root)]
+    while stack:
+        path, old_directory, new_directory = stack.pop()
+        if old_digest(old_directory, path) == new_digest(new_directory, path):
+            continue
+        old_content, new_content = old_entries(old_directory), new_entries(
+            new_directory
+        )
+        for name in sorted(old_content.keys() | new_content.keys()):
+            entry_path = f"{path}/{name}" if path else name
+            if name not in new_content:
+                removed[entry_path] = old_content[name]
+            elif name not in old_content:
+                added[entry_path] = new_content[name]
+            else:
+                old_entry, old_is_dir, old_value = old_content[name]
+                new_entry, new_is_dir, new_value = new_content[name]
+                if old_is_dir and new_is_dir:
+                    stack.append((entry_path, old_entry, new_entry))
+                elif old_is_dir or new_is_dir:
+                    removed[entry_path] = old_content[name]
+                    added[entry_path] = new_content[name]
+                elif old_value != new_value:
+                    diff.modified.append(entry_path)
+
+    # Move detection: pair entries with unique keys on both sides
+    def move_keys(
+        entries: Dict[str, Tuple[Any, bool, Any]],
+        digest: Callable[[Any, str], bytes],
+    ) -> Dict[Any, str]:
+        keys: Dict[Any, Optional[str]] = {}
+        for entry_path, (entry, is_dir, value) in entries.items():
+            if is_dir:
+                key: Any = ("D", digest(entry, entry_path))
+            elif value is not None:
+                key = ("F", value)
+            else:
+                continue
+            keys[key] = entry_path if key not in keys else None
+        return {key: entry_path for key, entry_path in keys.items() if entry_path}
+
+    new_keys = move_keys(added, new_digest)
+    for key, old_path in move_keys(removed, old_digest).items():
+        new_path = new_keys.get(key)
+        if new_path is not None:
+            diff.moved.append((old_path, new_path))
+            del removed[old_path], added[new_path]
+
+    diff.added = sorted(added)
+    diff.removed = sorted(removed)
+    diff.modified.sort()
+    diff.moved.sort()
+    return diff
+
+
+class SnapshotStore(ABC):
+    """Storage backend for snapshots cached by `get_folder_snapshot` (one per directory)"""
+
+    @abstractmethod
+    def load(self, key: str) -> Any:
+        """Returns data stored with given key, or None"""
+
+    @abstractmethod
+    def save(self, key: str, data: Any) -> None:
+        """Stores data with given key"""
+
+    def flush(self) -> None:
+        """Makes sure saved data is persisted"""
+
+
+class PickleFolderStore(SnapshotStore):
+    """Stores each snapshot in its own pickle file in `snapshot_folder` (see `get_snapshot_file`)"""
+
+    def __init__(self, snapshot_folder: Path) -> None:
+        ensure_dir_exists(snapshot_folder)
+        self.snapshot_folder = snapshot_folder
+
+    def load(self, key: str) -> Any:
+        try:
+            return unpickle_this(get_snapshot_file(self.snapshot_folder, key))
+        except Exception:
+            return None
+
+    def save(self, key: str, data: Any) -> None:
+        pickle_this(data, get_snapshot_file(self.snapshot_folder, key))
+
+
+class SQLiteSnapshotStore(SQLiteDatabase, SnapshotStore):
+    """Stores all snapshots in a single SQLite database file, which avoids creating a
+    multitude of small files. Snapshots are loaded on demand. Pending saves are committed by
+    `get_folder_snapshot` (see `SQLiteDatabase`).
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS snapshots (key TEXT PRIMARY KEY, data BLOB NOT NULL)",
+    )
+
+    def load(self, key: str) -> Any:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM snapshots WHERE key = ?", (key,)
+            ).fetchone()
+        return None if row is None else pickle.loads(row[0])  # nosec B301
+
+    def save(self, key: str, data: Any) -> None:
+        blob = pickle.dumps(data)
+        with self._lock:
+            self._write(
+                "INSERT OR REPLACE INTO snapshots (key, data) VALUES (?, ?)",
+                (key, blob),
+            )
+
+    def keys(self) -> List[str]:
+        """Returns keys of stored snapshots"""
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT key FROM snapshots")]
+
+
+SNAPSHOT_VALIDATIONS = ("file_count", "signature")
+
+
+def map_subdirectories(
+    func: Callable[[Path], Any], subdirectories: List[Path], workers: Optional[int]
+) -> Dict[Path, Any]:
+    """Returns ``{<subdirectory>: func(<subdirectory>)}``. If `workers` is greater than 1, calls
+    are made concurrently by a pool of `workers` threads (`func` must be thread-safe).
+    """
+    if workers is None or workers < 2 or len(subdirectories) < 2:
+        return {sub_dir: func(sub_dir) for sub_dir in subdirectories}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(subdirectories, executor.map(func, subdirectories)))
+
+
+def folder_snapshot_by_signature_h(
+    _dir: Path,
+    extentions: List[str],
+    store: SnapshotStore,
+    recursive: bool,
+    options: tuple,
+    workers: Optional[int] = None,
+    prune: Optional[PruneRules] = None,
+    prune_base: str = "",
+) -> dict:
+    """Recursive helper function to `folder_snapshot_by_signature`. Returns the "complex"
+    snapshot of `_dir`, whose listing is loaded from `store` if it was cached with the same
+    signature and `options`, else listed again and saved. Subdirectories of `_dir` are
+    processed by `workers` threads (see `map_subdirectories`).
+
+    `prune_base`: path of `_dir` relative to the root of `prune` rules, with a trailing '/'
+    """
+    key = str(_dir) + ".CS"
+    signature = directory_signature(_dir.stat())
+    cached = store.load(key)
+    # Listing: (<name>, <file path, or None for a subdirectory>) of each entry
+    entries: List[Tuple[str, Optional[Path]]]
+    if (
+        isinstance(cached, dict)
+        and cached.get("options") == options
+        and cached.get("signature") == signature
+    ):
+        entries = cached["entries"]
+    else:
+        LOG.debug("get_folder_snapshot: '%s' changed -> updating snapshot", _dir)
+        entries = []
+        for item in _dir.iterdir():
+            if prune and prune.excludes(prune_base + item.name, item.is_dir()):
+                continue
+            if item.is_file():
+                (name, ext) = (item.stem, item.suffix)
+                if ext in extentions:
+                    entries.append((name, item.resolve()))
+            elif item.is_dir():
+                if recursive:
+                    entries.append((item.name, None))
+            else:
+                raise ValueError(f"get_folder_snapshot::Not file or folder : {item}")
+        store.save(
+            key, {"options": options, "signature": signature, "entries": entries}
+        )
+
+    sub_snapshots = map_subdirectories(
+        lambda sub_dir: folder_snapshot_by_signature_h(
+            sub_dir,
+            extentions,
+            store,
+            recursive,
+            options,
+            prune=prune,
+            prune_base=f"{prune_base}{sub_dir.name}/",
+        ),
+        [_dir / name for name, path in entries if path is None],
+        workers,
+    )
+    content: Dict[str, Any] = {}
+    file_count = 0
+    for name, path in entries:
+        if path is None:
+            content_rec = sub_snapshots[_dir / name]
+            content[name] = content_rec
+            file_count += content_rec["__nbfiles__"]
+        else:
+            content[name] = path
+            file_count += 1
+    content["__nbfiles__"] = file_count
+    return content
+
+
+def folder_snapshot_by_signature(
+    _root: Path,
+    extentions: List[str],
+    store: SnapshotStore,
+    recursive: bool,
+    workers: Optional[int] = None,
+    prune: Optional[PruneRules] = None,
+    prune_base: str = "",
+) -> dict:
+    """Builds the "complex" snapshot of `_root` (see `get_folder_snapshot`), validating the cached
+    one with directory signatures (see `directory_signature`) : unchanged directories cost one
+    `stat` and one `store` lookup each, and only changed directories are listed again. Each
+    directory's listing is cached with its signature as its own entry, so only those of changed
+    directories are saved again. Subtrees of `_root` are processed by `workers` threads.
+    """
+    options = (sorted(extentions), recursive, prune.patterns if prune else None)
+    return folder_snapshot_by_signature_h(
+        _root, extentions, store, recursive, options, workers, prune, prune_base
+    )
+
+
 def get_folder_snapshot_h(
     _root: Path,
     extentions: Iterable[str],
-    snapshot_folder: Path,
+    snapshot_folder: Union[Path, SnapshotStore],
     recursive: bool = True,
     simplified: bool = False,
     rec: bool = False,
+    validation: str = "file_count",
+    workers: Optional[int] = None,
+    prune: Optional[PruneRules] = None,
+    prune_base: str = "",
 ) -> dict:
     """Recursive helper function to `get_folder_snapshot`.
     For more information see its docstring.
+
+    `prune_base`: path of `_root` relative to the root of `prune` rules, with a trailing '/'
     """
 
     # '*.txt' -> 'txt' extension conversion
     extentions = [e.replace("*.", ".") for e in extentions]
+    store = (
+        snapshot_folder
+        if isinstance(snapshot_folder, SnapshotStore)
+        else PickleFolderStore(snapshot_folder)
+    )
+    assertTrue(
+        validation in SNAPSHOT_VALIDATIONS,
+        "Unknown validation '{}'",
+        validation,
+    )
+    if validation == "signature" and not simplified:
+        return folder_snapshot_by_signature(
+            _root, extentions, store, recursive, workers, prune, prune_base
+        )
 
     # Check for cached results
     cache_file_name = str(_root) + (".S" if simplified else ".C")
-    cache_file = get_snapshot_file(snapshot_folder, cache_file_name)
-    try:
-        res = unpickle_this(cache_file)
-    except Exception:
-        res = None
+    res = store.load(cache_file_name)
     if res:
         if simplified:
             LOG.info("get_folder_snapshot: loaded from cache")
@@ -262,9 +2751,28 @@ def get_folder_snapshot_h(
     # Build from scratch
     LOG.info("get_folder_snapshot: from '%s' ..", _root)
     content: Dict[str, Any] = {}
+    items = [
+        item
+        for item in _root.iterdir()
+        if not (prune and prune.excludes(prune_base + item.name, item.is_dir()))
+    ]
+    sub_snapshots = map_subdirectories(
+        lambda sub_dir: get_folder_snapshot_h(
+            sub_dir,
+            extentions,
+            store,
+            recursive,
+            simplified,
+            rec=True,
+            prune=prune,
+            prune_base=f"{prune_base}{sub_dir.name}/",
+        ),
+        [item for item in items if item.is_dir()] if recursive else [],
+        workers,
+    )
 
     if simplified:  # "simplified" version
-        for item in _root.iterdir():
+        for item in items:
             if item.is_file():
                 (name, ext) = (item.stem, item.suffix)
                 if ext not in extentions:
@@ -273,16 +2781,14 @@ def get_folder_snapshot_h(
             elif item.is_dir():
                 if not recursive:
                     continue
-                content_rec = get_folder_snapshot_h(
-                    item, extentions, snapshot_folder, recursive, simplified, rec=True
-                )
+                content_rec = sub_snapshots[item]
                 content.update(content_rec)
             else:
                 raise ValueError(f"get_folder_snapshot::Not file or folder : {item}")
 
     else:  # "complex" version
         file_count = 0
-        for item in _root.iterdir():
+        for item in items:
             if item.is_file():
                 (name, ext) = (item.stem, item.suffix)
                 if ext not in extentions:
@@ -292,9 +2798,7 @@ def get_folder_snapshot_h(
             elif item.is_dir():
                 if not recursive:
                     continue
-                content_rec = get_folder_snapshot_h(
-                    item, extentions, snapshot_folder, recursive, simplified, rec=True
-                )
+                content_rec = sub_snapshots[item]
                 content[item.name] = content_rec
                 file_count += content_rec["__nbfiles__"]
             else:
@@ -308,7 +2812,7 @@ def get_folder_snapshot_h(
 
     # Caching for later use
     if not (simplified and rec):
-        pickle_this(content, cache_file)
+        store.save(cache_file_name, content)
 
     return content
 
@@ -316,14 +2820,34 @@ def get_folder_snapshot_h(
 def get_folder_snapshot(
     _root: Path,
     extentions: Iterable[str],
-    snapshot_folder: Path,
+    snapshot_folder: Union[Path, SnapshotStore],
     recursive: bool = True,
     simplified: bool = False,
+    validation: str = "file_count",
+    workers: Optional[int] = None,
+    prune: Optional[PruneRules] = None,
 ) -> dict:
     """Recursively builds a dictionnary representation of a directory tree. Only listed file extensions are considered.
 
     `extensions` : iterable of ``'*.ext'`` or ``'.ext'``
 
+    `snapshot_folder` : where to cache snapshots; either a directory (one pickle file per directory,
+    see `PickleFolderStore`) or a `SnapshotStore` (eg: `SQLiteSnapshotStore` for a single file)
+
+    `validation` : how a cached "complex" snapshot is checked before being returned :
+     - ``'file_count'`` : compares recursive file counts at every directory level (slow on deep trees)
+     - ``'signature'`` : compares directory mtime/ctime signatures stored with each directory's
+       listing, so unchanged directories cost one `stat` each and only changed directories are
+       listed again and saved
+    Cached "simplified" snapshots are always returned as is.
+
+    `workers` : if greater than 1, subdirectories of `_root` are processed concurrently by this many
+    threads (each subtree is then processed sequentially); useful on fast storage (SSD, RAID)
+
+    `prune` : exclusion rules (see `PruneRules`); excluded directories are not explored. With
+    ``'file_count'`` validation, cached snapshots don't record rules : clear the cache after
+    changing them.
+
     Rules ("complex") :
      - The returned dictionnary has one entry : 'root'
      - An entry E can have one of three values according to  :
@@ -381,7 +2905,21 @@ def get_folder_snapshot(
             'file8': '<root>/A/T/file8.png'
         }
     """
-    ensure_dir_exists(snapshot_folder)
-    return get_folder_snapshot_h(
-        _root, extentions, snapshot_folder, recursive, simplified
+    store = (
+        snapshot_folder
+        if isinstance(snapshot_folder, SnapshotStore)
+        else PickleFolderStore(snapshot_folder)
     )
+    try:
+        return get_folder_snapshot_h(
+            _root,
+            extentions,
+            store,
+            recursive,
+            simplified,
+            validation=validation,
+            workers=workers,
+            prune=prune,
+        )
+    finally:
+        store.flush()
@@ -6,55 +6,645 @@ Useful tools for easily hashing files. See crctools.utils for more functions.
 """
 
 import hashlib
+import io
+import itertools
 import logging
+import mmap
+import os
+import queue
+import threading
+import time
 import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, Optional
+from stat import S_ISREG
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 from .os_detect import Os
-from .path_tools import ensure_dir_exists, file_collector
+from .path_tools import PruneRules, ensure_dir_exists, file_collector
 from .spinner import MySpinner
-from .utils import assertTrue, pickle_this, unpickle_this
+from .utils import SQLiteDatabase, assertTrue, pickle_this, unpickle_this
 
-BLOCKSIZE = 65_536  # 2 ** 16
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+BLOCKSIZE = 65_536  # 2 ** 16; no longer used (see READ_SIZE), kept for backward-compatible imports
+READ_SIZE = 1_048_576  # 2 ** 20
+HASH_MODES = ("buffered", "pipelined", "mmap")
+PIPELINE_DEPTH = 3  # number of buffers in flight between reader thread and hasher
+SAMPLE_WINDOWS = 8
+SAMPLE_WINDOW_SIZE = 65_536  # 2 ** 16
+PARTIAL_HASH_STRATEGIES = ("head", "sampled")
+TREE_HASH_QUEUE_SIZE = 1024  # files waiting to be hashed by `tree_hash` workers
+SCRUB_STATUSES = ("mismatch", "missing", "new", "unreadable")
 log = logging.getLogger(__file__)
 spinner = MySpinner()
 current_os = Os()
 
+# <algorithm name> -> <hasher factory>; optional algorithms are only listed if available
+HASH_ALGORITHMS: Dict[str, Callable[[], Any]] = {
+    "md5": lambda: hashlib.md5(),  # nosec B324
+    "sha1": lambda: hashlib.sha1(),  # nosec B324
+    "sha256": hashlib.sha256,
+    "blake2b": hashlib.blake2b,
+    "blake2s": hashlib.blake2s,
+}
+if blake3 is not None:
+    HASH_ALGORITHMS["blake3"] = lambda: blake3.blake3(max_threads=blake3.blake3.AUTO)
+if xxhash is not None:
+    HASH_ALGORITHMS.update(
+        xxh64=xxhash.xxh64, xxh3_64=xxhash.xxh3_64, xxh3_128=xxhash.xxh3_128
+    )
+
 
-def file_hash(file: Path) -> str:
-    """Returns the md5 hash of the corresponding file
-    Reads the file in 2^16 bytes (~65Ko) chunks
+def new_hasher(algorithm: str = "md5") -> Any:
+    """Returns a new hasher object (with `update` and `hexdigest` methods) for `algorithm`:
+    - from the standard library: 'md5', 'sha1', 'sha256', 'blake2b', 'blake2s'
+    - 'blake3' (multithreaded, fastest on large files), if package `blake3` is installed
+    - 'xxh64', 'xxh3_64', 'xxh3_128' (non-cryptographic), if package `xxhash` is installed
     """
+    assertTrue(
+        algorithm in HASH_ALGORITHMS,
+        "Unknown or unavailable hash algorithm '{}' (available: {})",
+        algorithm,
+        list(HASH_ALGORITHMS),
+    )
+    return HASH_ALGORITHMS[algorithm]()
+
+
+def _hash_mmap(
+    f: BinaryIO, hasher: Any, block_size: int, max_bytes: Optional[int]
+) -> bool:
+    """Feeds content of `f` (from current position, up to `max_bytes` bytes) to `hasher` by
+    memory-mapping it: `hasher` is given slices of the mapping, so nothing is copied nor allocated
+    per block. Returns False if `f` can't be memory-mapped (not a regular file, empty file,
+    unsupported file system, etc), in which case nothing was hashed."""
+    try:
+        fileno = f.fileno()
+        if not S_ISREG(os.fstat(fileno).st_mode):
+            return False
+        mapped = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        return False
+
+    with mapped:
+        if hasattr(mmap, "MADV_SEQUENTIAL"):  # Linux & co, Python 3.8+
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        position = f.tell()
+        end = (
+            len(mapped) if max_bytes is None else min(len(mapped), position + max_bytes)
+        )
+        view = memoryview(mapped)
+        try:
+            for start in range(position, end, block_size):
+                hasher.update(view[start : min(start + block_size, end)])
+        finally:
+            view.release()
+        f.seek(max(position, end))
+    return True
+
+
+def hash_stream(
+    f: BinaryIO,
+    hasher: Any,
+    block_size: int = READ_SIZE,
+    mode: str = "buffered",
+    max_bytes: Optional[int] = None,
+) -> None:
+    """Feeds content of binary stream `f` (from current position) to `hasher`.
+
+    `block_size`: read size, in bytes; reads go to a reused buffer (no allocation per read)
+
+    `mode`:
+     - 'buffered': reads and hashes alternately
+     - 'pipelined': a reader thread fills buffers while the current thread hashes, so reading
+       and hashing overlap (hashlib releases the GIL on large updates); best on fast storage
+       with a slow algorithm
+     - 'mmap': memory-maps the file and hashes it in place, without any copy (see `_hash_mmap`);
+       best for large files. Falls back to 'buffered' if `f` can't be memory-mapped. Note: the
+       process may crash (SIGBUS) if the file is truncated while being hashed
+
+    `max_bytes`: if given, stops after this many bytes
+    """
+    assertTrue(mode in HASH_MODES, "Unknown hash mode '{}'", mode)
+    remaining = max_bytes
+
+    def read_into(buffer: memoryview) -> int:
+        """Reads into `buffer`, without exceeding `max_bytes` in total"""
+        nonlocal remaining
+        if remaining is not None:
+            buffer = buffer[:remaining]
+            if not buffer:
+                return 0
+        size = f.readinto(buffer)  # type: ignore[attr-defined]
+        if remaining is not None and size:
+            remaining -= size
+        return size
+
+    if mode == "mmap" and _hash_mmap(f, hasher, block_size, max_bytes):
+        return
+
+    if mode != "pipelined":
+        view = memoryview(bytearray(block_size))
+        size = read_into(view)
+        while size:
+            hasher.update(view[:size])
+            size = read_into(view)
+        return
+
+    free_buffers: "queue.Queue[Optional[memoryview]]" = queue.Queue()
+    filled_buffers: "queue.Queue[Any]" = queue.Queue()
+    for _ in range(PIPELINE_DEPTH):
+        free_buffers.put(memoryview(bytearray(block_size)))
+
+    def reader() -> None:
+        try:
+            while True:
+                _buffer = free_buffers.get()
+                if _buffer is None:  # hashing stopped
+                    return
+                _size = read_into(_buffer)
+                filled_buffers.put((_buffer, _size))
+                if not _size:
+                    return
+        except Exception as e:
+            filled_buffers.put((e, 0))
+
+    reader_thread = threading.Thread(target=reader, daemon=True)
+    reader_thread.start()
+    try:
+        while True:
+            buffer, size = filled_buffers.get()
+            if isinstance(buffer, Exception):
+                raise buffer
+            if not size:
+                break
+            hasher.update(buffer[:size])
+            free_buffers.put(buffer)
+    finally:
+        free_buffers.put(None)
+        reader_thread.join()
+
+
+def _signed64(value: int) -> int:
+    """Maps unsigned 64-bit integers (eg: inodes) to SQLite's signed 64-bit integers"""
+    return value - (1 << 64) if (1 << 63) <= value else value
+
+
+class HashCache(SQLiteDatabase):
+    """Persistent cache of file hashes, stored in a single SQLite database file (see
+    `SQLiteDatabase` for batching and thread safety).
+
+    Entries are keyed by (<device>, <inode>, <algorithm>) and valid as long as the file's size and
+    mtime (ns) are unchanged, so modified files are hashed again while moved or renamed files (on
+    the same device) are not. Each entry also records the last path it was seen at and when it
+    was last used, for eviction (see `prune`).
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS hashes ("
+        "device INTEGER, inode INTEGER, algorithm TEXT, size INTEGER NOT NULL, "
+        "mtime_ns INTEGER NOT NULL, digest TEXT NOT NULL, path TEXT NOT NULL, "
+        "used REAL NOT NULL, PRIMARY KEY (device, inode, algorithm))",
+    )
+
+    def get(
+        self,
+        file: Path,
+        algorithm: str = "md5",
+        stat_result: Optional[os.stat_result] = None,
+    ) -> Optional[str]:
+        """Returns cached hash of `file`, or None if unknown or outdated"""
+        stat = stat_result or file.stat()
+        key = (_signed64(stat.st_dev), _signed64(stat.st_ino), algorithm)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime_ns, digest, path FROM hashes "
+                "WHERE device = ? AND inode = ? AND algorithm = ?",
+                key,
+            ).fetchone()
+            if row is None or row[:2] != (stat.st_size, stat.st_mtime_ns):
+                return None
+            self._write(
+                "UPDATE hashes SET used = ?, path = ? "
+                "WHERE device = ? AND inode = ? AND algorithm = ?",
+                (time.time(), str(file)) + key,
+            )
+        return row[2]
+
+    def put(
+        self,
+        file: Path,
+        digest: str,
+        algorithm: str = "md5",
+        stat_result: Optional[os.stat_result] = None,
+    ) -> None:
+        """Records hash of `file`"""
+        stat = stat_result or file.stat()
+        with self._lock:
+            self._write(
+                "INSERT OR REPLACE INTO hashes "
+                "(device, inode, algorithm, size, mtime_ns, digest, path, used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    _signed64(stat.st_dev),
+                    _signed64(stat.st_ino),
+                    algorithm,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    digest,
+                    str(file),
+                    time.time(),
+                ),
+            )
+
+    def file_hash(self, file: Path, algorithm: str = "md5", **kwargs: Any) -> str:
+        """Returns hash of `file` from cache, or computes (see `file_hash`) and caches it. A hash is
+        not cached if the file was modified while being hashed."""
+        stat = file.stat()
+        hash_s = self.get(file, algorithm, stat)
+        if hash_s is not None:
+            log.debug("Cache hit")
+            return hash_s
+        hash_s = file_hash(file, algorithm, **kwargs)
+        stat_after = file.stat()
+        if (stat.st_size, stat.st_mtime_ns) == (
+            stat_after.st_size,
+            stat_after.st_mtime_ns,
+        ):
+            self.put(file, hash_s, algorithm, stat)
+        return hash_s
+
+    def prune(self, max_age: Optional[float] = None) -> int:
+        """Evicts entries whose file vanished or changed since it was last seen, and entries not
+        used for more than `max_age` seconds (if given). Returns the number of evicted entries.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT device, inode, algorithm, size, mtime_ns, path, used FROM hashes"
+            ).fetchall()
+        oldest = None if max_age is None else time.time() - max_age
+        evicted = []
+        for device, inode, algorithm, size, mtime_ns, path, used in rows:
+            try:
+                stat = os.stat(path)
+                valid = (
+                    _signed64(stat.st_dev),
+                    _signed64(stat.st_ino),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                ) == (device, inode, size, mtime_ns)
+            except OSError:
+                valid = False
+            if not valid or (oldest is not None and used < oldest):
+                evicted.append((device, inode, algorithm))
+        with self._lock:
+            self._db.executemany(
+                "DELETE FROM hashes WHERE device = ? AND inode = ? AND algorithm = ?",
+                evicted,
+            )
+            self._db.commit()
+            self._pending = 0
+        log.debug("HashCache: evicted %s entries", len(evicted))
+        return len(evicted)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
 
-    hasher = hashlib.md5()  # nosec B324
-    with file.open(mode="rb") as f:
-        chunk = f.read(BLOCKSIZE)
-        while 0 < len(chunk):
-            hasher.update(chunk)
-            chunk = f.read(BLOCKSIZE)
+
+def file_hash(
+    file: Path,
+    algorithm: str = "md5",
+    block_size: int = READ_SIZE,
+    mode: str = "buffered",
+    cache: Optional[HashCache] = None,
+) -> str:
+    """Returns the hash (hexadecimal digest) of the corresponding file; md5 by default.
+    For `algorithm` see `new_hasher`, for `block_size` and `mode` see `hash_stream`.
+
+    `cache`: if given, the hash is only computed if `cache` has no valid entry for the file
+    """
+    if cache is not None:
+        return cache.file_hash(file, algorithm, block_size=block_size, mode=mode)
+
+    hasher = new_hasher(algorithm)
+    with file.open(mode="rb", buffering=0) as f:
+        # No need for a buffer larger than the file (+1 byte to reach end of file in one read)
+        stat_result = os.fstat(f.fileno())
+        if S_ISREG(stat_result.st_mode):
+            block_size = min(block_size, stat_result.st_size + 1)
+        hash_stream(f, hasher, block_size, mode)
 
     hash_s = hasher.hexdigest()
 
-    log.debug("File %s has md5 hash %s.", file, hash_s)
+    log.debug("File %s has %s hash %s.", file, algorithm, hash_s)
     return hash_s
 
 
-def partial_MD5(file: Path) -> str:
-    """Reads up to 10MB of the given file and returns MD5 (partial) checksum. Borrowing code from : https://stackoverflow.com/a/1131238
-    This is achieved by reading 10 times ~1MB, thus reducing RAM usage.
+def hash_files(
+    paths: Iterable[Path],
+    workers: Optional[int] = None,
+    algorithm: str = "md5",
+    max_in_flight: int = 256 * READ_SIZE,
+    **kwargs: Any,
+) -> Iterator[Tuple[Path, Optional[str]]]:
+    """Hashes many files concurrently (see `file_hash`) using a pool of `workers` threads (default:
+    `ThreadPoolExecutor`'s default); hashlib releases the GIL while hashing, so this scales with
+    cores and storage queue depth. Yields (<path>, <hash>) as soon as each file is hashed; hash is
+    None if the file couldn't be read (a warning is logged).
+
+    Files are hashed smallest first, so that many small files keep workers busy while large ones
+    are read. At most `max_in_flight` bytes (sum of file sizes; default: 256 MiB) are being hashed
+    at any time, except when a single file is larger.
+
+    `kwargs`: passed to `file_hash` (`block_size`, `mode`, `cache`)
     """
+    new_hasher(algorithm)  # fails early on unknown algorithm
+    files = []
+    for path in paths:
+        try:
+            files.append((path.stat().st_size, path))
+        except OSError as e:
+            log.warning("hash_files: couldn't access '%s': %s", path, e)
+            yield path, None
+    files.sort(key=lambda size_path: size_path[0])
+
+    _workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=_workers) as executor:
+        pending: Dict[Future, Tuple[Path, int]] = {}
+        in_flight = 0
+        position = 0
+        while position < len(files) or pending:
+            # Submit files while limits allow it; there is always at least one pending file
+            while (
+                position < len(files)
+                and len(pending) < 4 * _workers
+                and (not pending or in_flight + files[position][0] <= max_in_flight)
+            ):
+                size, path = files[position]
+                position += 1
+                future = executor.submit(file_hash, path, algorithm, **kwargs)
+                pending[future] = (path, size)
+                in_flight += size
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, size = pending.pop(future)
+                in_flight -= size
+                try:
+                    digest: Optional[str] = future.result()
+                except OSError as e:
+                    log.warning("hash_files: couldn't hash '%s': %s", path, e)
+                    digest = None
+                yield path, digest
+
+
+def _pread(fd: int, size: int, offset: int) -> bytes:
+    """Reads up to `size` bytes at `offset` (less at end of file) without using the file
+    position where `os.pread` is available; elsewhere (Windows) uses seek then read."""
+    if not hasattr(os, "pread"):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+    data = os.pread(fd, size, offset)
+    while data and len(data) < size:  # short read
+        more = os.pread(fd, size - len(data), offset + len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def sampled_hash(
+    file: Path,
+    algorithm: str = "md5",
+    windows: int = SAMPLE_WINDOWS,
+    window_size: int = SAMPLE_WINDOW_SIZE,
+) -> str:
+    """Returns a fingerprint of `file` in constant time, whatever its size: the hash of its size
+    followed by `windows` evenly spaced windows of `window_size` bytes (the first one at the
+    start of the file, the last one at its end). Files no larger than ``windows * window_size``
+    are hashed entirely (after their size). Windows are read with `os.pread`.
+
+    Files with different fingerprints differ, but files with identical fingerprints may differ
+    outside of the windows. Fingerprints are not comparable with `file_hash` results.
+    """
+    assertTrue(
+        0 < windows and 0 < window_size, "windows and window_size must be positive"
+    )
+    hasher = new_hasher(algorithm)
+    fd = os.open(file, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        size = os.fstat(fd).st_size
+        hasher.update(size.to_bytes(8, "little"))
+        if size <= windows * window_size:
+            offsets = range(0, size, window_size)
+        elif windows == 1:
+            offsets = range(1)
+        else:
+            step = (size - window_size) / (windows - 1)
+            offsets = [round(i * step) for i in range(windows)]  # type: ignore[assignment]
+        for offset in offsets:
+            hasher.update(_pread(fd, window_size, offset))
+    finally:
+        os.close(fd)
+
+    return hasher.hexdigest()
+
+
+def partial_MD5(
+    file: Path,
+    mode: str = "buffered",
+    strategy: str = "head",
+    windows: int = SAMPLE_WINDOWS,
+    window_size: int = SAMPLE_WINDOW_SIZE,
+) -> str:
+    """Returns MD5 (partial) checksum of the given file, for quick comparisons. Borrowing code from : https://stackoverflow.com/a/1131238
+
+    `strategy`:
+     - 'head': reads up to 10MB of the file, 10 times ~1MB into a reused buffer, thus reducing
+       RAM usage. Blind to files differing after their first 10MB
+     - 'sampled': see `sampled_hash` (with `windows` and `window_size`); reads a constant amount
+       of data over the whole file, and accounts for its size
+
+    `mode`: see `hash_stream` ('head' strategy only)
+    """
+    assertTrue(
+        strategy in PARTIAL_HASH_STRATEGIES,
+        "Unknown partial hash strategy '{}'",
+        strategy,
+    )
+    if strategy == "sampled":
+        return sampled_hash(file, "md5", windows, window_size)
+
     hasher = hashlib.md5()  # nosec B324
-    with file.open(mode="rb") as f:
-        for _ in range(10):
-            chunk = f.read(1_048_576)
-            if not chunk:
-                break
-            hasher.update(chunk)
+    with file.open(mode="rb", buffering=0) as f:
+        hash_stream(f, hasher, 1_048_576, mode, max_bytes=10 * 1_048_576)
 
     return hasher.hexdigest()
 
 
+def _files_by_size(
+    roots: Iterable[Path], min_size: int, prune: Optional[PruneRules]
+) -> Dict[int, List[Path]]:
+    """Walks `roots` and returns {<size>: [<file>, ..]} for files of at least `min_size` bytes.
+    Symbolic links are ignored, as are additional hard links to an already seen file."""
+    by_size: Dict[int, List[Path]] = {}
+    seen = set()
+    for root in roots:
+        stack = [(str(root.resolve()), "")]
+        while stack:
+            _dir, rel_dir = stack.pop()
+            try:
+                with os.scandir(_dir) as entries:
+                    for entry in entries:
+                        rel_path = rel_dir + entry.name
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        if prune and prune.excludes(rel_path, is_dir):
+                            continue
+                        if is_dir:
+                            stack.append((entry.path, rel_path + "/"))
+                            continue
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        stat = entry.stat(follow_symlinks=False)
+                        if stat.st_size < min_size:
+                            continue
+                        if 1 < stat.st_nlink:
+                            if (stat.st_dev, stat.st_ino) in seen:
+                                continue
+                            seen.add((stat.st_dev, stat.st_ino))
+                        by_size.setdefault(stat.st_size, []).append(Path(entry.path))
+            except OSError as e:
+                log.warning("find_duplicates: couldn't list '%s': %s", _dir, e)
+    return by_size
+
+
+@dataclass
+class _HashGroup:
+    """Group of same-size files being hashed by `find_duplicates`"""
+
+    size: int
+    stage: int
+    remaining: int  # number of files left to hash
+    files_by_hash: Dict[str, List[Path]] = field(default_factory=dict)
+
+
+def find_duplicates(
+    roots: Iterable[Path],
+    workers: Optional[int] = None,
+    algorithm: str = "md5",
+    min_size: int = 1,
+    windows: int = 3,
+    window_size: int = READ_SIZE,
+    prune: Optional[PruneRules] = None,
+) -> Iterator[Tuple[int, List[Path]]]:
+    """Finds files with identical content under `roots`, in stages so that most files are never
+    read entirely:
+     1. files are grouped by size (directory listing metadata only)
+     2. files with the same size are grouped by their `sampled_hash` (`windows` windows of
+        `window_size` bytes; by default the first, middle and last MiB), which covers the whole
+        file if it is small enough
+     3. remaining groups are confirmed with full hashes (see `file_hash`)
+
+    Stages 2 and 3 run concurrently on a pool of `workers` threads: a group reaches stage 3 as
+    soon as its stage 2 hashes are known. Yields (<size>, <files with identical content>) as
+    soon as each group is confirmed. Unreadable files are skipped with a warning.
+
+    `min_size`: smaller files are ignored (default: empty files are ignored)
+
+    `prune`: exclusion rules (see `PruneRules`)
+    """
+    new_hasher(algorithm)  # fails early on unknown algorithm
+    by_size = _files_by_size(roots, min_size, prune)
+    _workers = workers or min(32, (os.cpu_count() or 1) + 4)
+
+    groups: Dict[int, _HashGroup] = {}
+    group_ids = itertools.count()
+    full_hash_jobs: Deque[Tuple[int, Path]] = deque()
+
+    def partial_hash_jobs() -> Iterator[Tuple[int, Path]]:
+        for size, files in by_size.items():
+            if len(files) < 2:
+                continue
+            group_id = next(group_ids)
+            groups[group_id] = _HashGroup(size, 2, len(files))
+            for file in files:
+                yield group_id, file
+
+    partial_jobs = partial_hash_jobs()
+    completed: "queue.Queue[Tuple[int, Path, Future]]" = queue.Queue()
+    with ThreadPoolExecutor(max_workers=_workers) as executor:
+        pending = 0
+
+        def on_done(group_id: int, file: Path) -> Callable[[Future], None]:
+            """Returns a callback queueing the completed future with its job"""
+            return lambda future: completed.put((group_id, file, future))
+
+        def submit_jobs() -> None:
+            """Submits jobs (stage 3 first, to yield results early) up to a limit"""
+            nonlocal pending
+            while pending < 4 * _workers:
+                if full_hash_jobs:
+                    group_id, file = full_hash_jobs.popleft()
+                    future = executor.submit(file_hash, file, algorithm)
+                else:
+                    job = next(partial_jobs, None)
+                    if job is None:
+                        return
+                    group_id, file = job
+                    future = executor.submit(
+                        sampled_hash, file, algorithm, windows, window_size
+                    )
+                future.add_done_callback(on_done(group_id, file))
+                pending += 1
+
+        submit_jobs()
+        while pending:
+            group_id, file, future = completed.get()
+            pending -= 1
+            group = groups[group_id]
+            group.remaining -= 1
+            try:
+                group.files_by_hash.setdefault(future.result(), []).append(file)
+            except OSError as e:
+                log.warning("find_duplicates: couldn't hash '%s': %s", file, e)
+            if group.remaining == 0:
+                del groups[group_id]
+                for files in group.files_by_hash.values():
+                    if len(files) < 2:
+                        continue
+                    if group.stage == 3 or group.size <= windows * window_size:
+                        yield group.size, sorted(files)
+                        continue
+                    # Candidates for stage 3
+                    new_group_id = next(group_ids)
+                    groups[new_group_id] = _HashGroup(group.size, 3, len(files))
+                    full_hash_jobs.extend((new_group_id, file) for file in files)
+            submit_jobs()
+
+
 def path_to_id(_path: Path, limit_id_len: bool = True) -> str:
     """Returns a string identifier for any given file/directory path.
 
@@ -75,18 +665,27 @@ def directory_hash(
     directory: Path,
     pattern: str = "*.*",
     old_hashes: Optional[dict] = None,
+    workers: int = 1,
+    cache: Optional[HashCache] = None,
 ) -> Dict[str, str]:
     """Returns a dictionnary of md5 hash of all the files in the directory
     corresponding to path 'directory'.
 
+    `old_hashes`: previous result, reused for files with the same name; ignored if `cache` is given
+
+    `workers`: number of files hashed concurrently (see `hash_files`)
+
+    `cache`: if given, only files that changed since they were cached are hashed (see `HashCache`)
+
     Returns: Dict[<file_name:str>, <file_hash:str>]
     """
 
     files = file_collector(root=directory, pattern=pattern)
-    if old_hashes is None:
+    if old_hashes is None or cache is not None:
         old_hashes = {}
 
     hashes = {}
+    to_hash = []
     for file in files:
         key = file.name
         if key in old_hashes:
@@ -94,39 +693,194 @@ def directory_hash(
             hashes[key] = old_hashes[key]
             continue
 
-        hashes[key] = file_hash(file)
+        to_hash.append(file)
+
+    for file, hash_s in hash_files(to_hash, workers, cache=cache):
+        if hash_s is not None:
+            hashes[file.name] = hash_s
 
     return hashes
 
 
+class HashDB(SQLiteDatabase):
+    """Stores `tree_hash` results in a single SQLite database file, instead of one pickle file per
+    directory: no id truncation (thus no collision), no directory listing, and fast lookups by
+    path (`lookup_path`) or by hash (`lookup_hash`). Writes are counted in rows (see
+    `SQLiteDatabase`). Use `export` to produce the former layout (see `tree_hash`).
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, updated REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS files (folder TEXT NOT NULL, name TEXT NOT NULL, "
+        "digest TEXT NOT NULL, PRIMARY KEY (folder, name))",
+        "CREATE INDEX IF NOT EXISTS files_digest ON files (digest)",
+    )
+
+    def __init__(self, db_file: Path, batch_size: int = 10_000) -> None:
+        super().__init__(db_file, batch_size)
+
+    def save_directory(self, folder: Path, hashes: Dict[str, str]) -> None:
+        """Records hashes of files in `folder` (as returned by `directory_hash`), replacing any
+        previous record"""
+        folder_s = str(folder)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO folders (folder, updated) VALUES (?, ?)",
+                (folder_s, time.time()),
+            )
+            self._db.execute("DELETE FROM files WHERE folder = ?", (folder_s,))
+            self._db.executemany(
+                "INSERT INTO files (folder, name, digest) VALUES (?, ?, ?)",
+                [(folder_s, name, digest) for name, digest in hashes.items()],
+            )
+            self._written(1 + len(hashes))
+
+    def load_directory(self, folder: Path) -> Optional[Dict[str, str]]:
+        """Returns recorded hashes of files in `folder`, or None if it wasn't recorded"""
+        folder_s = str(folder)
+        with self._lock:
+            if (
+                self._db.execute(
+                    "SELECT 1 FROM folders WHERE folder = ?", (folder_s,)
+                ).fetchone()
+                is None
+            ):
+                return None
+            return dict(
+                self._db.execute(
+                    "SELECT name, digest FROM files WHERE folder = ?", (folder_s,)
+                )
+            )
+
+    def folders(self) -> List[Path]:
+        """Returns recorded folders"""
+        with self._lock:
+            return [
+                Path(row[0]) for row in self._db.execute("SELECT folder FROM folders")
+            ]
+
+    def lookup_path(self, file: Path) -> Optional[str]:
+        """Returns recorded hash of `file`, if any"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT digest FROM files WHERE folder = ? AND name = ?",
+                (str(file.parent), file.name),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def lookup_hash(self, digest: str) -> List[Path]:
+        """Returns recorded files with given hash"""
+        with self._lock:
+            return [
+                Path(folder) / name
+                for folder, name in self._db.execute(
+                    "SELECT folder, name FROM files WHERE digest = ?", (digest,)
+                )
+            ]
+
+    def export(self, hash_location: Path) -> int:
+        """Writes recorded hashes to `hash_location` with the layout `tree_hash` uses without a
+        `HashDB` (one pickle file per folder, named with `path_to_id`). Folders whose file can't
+        be written (eg: id collision) are skipped with a warning. Returns the number of files
+        written."""
+        ensure_dir_exists(hash_location)
+        written = 0
+        for folder in self.folders():
+            savefile = hash_location / path_to_id(folder)
+            try:
+                ensure_dir_exists(savefile.parent)
+                pickle_this(
+                    {"folder": folder, "hashes": self.load_directory(folder)}, savefile
+                )
+                written += 1
+            except (OSError, ValueError) as e:
+                log.warning("HashDB.export: couldn't write '%s': %s", savefile, e)
+        return written
+
+
 def tree_hash(
     root: Path,
-    hash_location: Path,
+    hash_location: Union[Path, HashDB],
     pattern: str = "*.*",
     fastload: bool = False,
+    cache: Optional[HashCache] = None,
+    workers: int = 1,
+    queue_size: int = TREE_HASH_QUEUE_SIZE,
 ) -> None:
     """Explores the directory structure recursively from 'root', computing their hash.
     For each directory explored, saves hashes found to a file.
 
+    `hash_location`: where to save hashes: a directory (one pickle file per directory, named with
+    `path_to_id`) or a `HashDB` (single file)
+
     `fastload`: If True and the corresponding hash file is found, hashes are not re-checked. This
     is used for performance reasons. Do not use if changes are likely.
 
+    `cache`: if given, only files that changed since they were cached are hashed (see `HashCache`)
+
+    `workers`: if more than 1, directories are walked by a producer thread while `workers`
+    threads hash their files and the current thread saves hashes of each directory once all its
+    files are hashed (see `tree_hash_parallel`)
+
+    `queue_size`: maximum number of files waiting to be hashed (with `workers`); bounds memory
+    usage whatever the size of the tree
+
     """
 
     root = root.resolve()
-    hash_location = hash_location.resolve()
     assertTrue(root.is_dir(), "Root dir must exist: '{}'", root)
-    ensure_dir_exists(hash_location)
+    assertTrue(0 < workers, "workers must be positive, not {}", workers)
+    if not isinstance(hash_location, HashDB):
+        hash_location = hash_location.resolve()
+        ensure_dir_exists(hash_location)
+
+    try:
+        if 1 < workers:
+            tree_hash_parallel(
+                root, hash_location, pattern, fastload, cache, workers, queue_size
+            )
+        else:
+            tree_hash_h(root, hash_location, pattern, fastload, cache)
+    finally:
+        if isinstance(hash_location, HashDB):
+            hash_location.flush()
+
 
+def tree_hash_h(
+    root: Path,
+    hash_location: Union[Path, HashDB],
+    pattern: str,
+    fastload: bool,
+    cache: Optional[HashCache],
+) -> None:
+    """Recursive helper function to `tree_hash`.
+    For more information see its docstring.
+    """
     subdirectories = [x for x in root.iterdir() if x.is_dir() and x != hash_location]
     for sub_dir in subdirectories:
+        if isinstance(hash_location, HashDB):
+            old_hashes = hash_location.load_directory(sub_dir)
+            if not (fastload and old_hashes is not None):
+                spinner.animation()
+                hashes = directory_hash(
+                    directory=sub_dir,
+                    pattern=pattern,
+                    old_hashes=old_hashes,
+                    cache=cache,
+                )
+                hash_location.save_directory(sub_dir, hashes)
+            else:
+                spinner.animation(text="cache hit")
+            tree_hash_h(sub_dir, hash_location, pattern, fastload, cache)
+            continue
+
         savefile = hash_location / path_to_id(sub_dir)
 
         if not (fastload and savefile.is_file()):
             old_hashes = unpickle_this(savefile)
             spinner.animation()
             hashes = directory_hash(
-                directory=sub_dir, pattern=pattern, old_hashes=old_hashes
+                directory=sub_dir, pattern=pattern, old_hashes=old_hashes, cache=cache
             )
             data = {"folder": sub_dir, "hashes": hashes}
 
@@ -135,12 +889,272 @@ def tree_hash(
             spinner.animation(text="cache hit")
 
         # Recursion
-        tree_hash(
-            root=sub_dir,
-            hash_location=hash_location,
-            pattern=pattern,
-            fastload=fastload,
-        )
+        tree_hash_h(sub_dir, hash_location, pattern, fastload, cache)
+
+
+def tree_hash_parallel(
+    root: Path,
+    hash_location: Union[Path, HashDB],
+    pattern: str,
+    fastload: bool,
+    cache: Optional[HashCache],
+    workers: int,
+    queue_size: int,
+) -> None:
+    """Concurrent version of `tree_hash_h`, with the same results. For more information see
+    `tree_hash` docstring.
+
+    A producer thread walks the tree and puts files to hash in a queue of at most `queue_size`
+    files, so it waits for hashing workers when it gets ahead. `workers` threads hash them, and
+    the current thread gathers results and saves hashes of each directory as soon as all its
+    files are hashed. Unreadable files are skipped with a warning, like in `directory_hash`.
+    """
+    files_to_hash: "queue.Queue[Optional[Tuple[Path, Path]]]" = queue.Queue(
+        maxsize=queue_size
+    )
+    results: "queue.Queue[Tuple[Any, ...]]" = queue.Queue()
+    stop = threading.Event()
+
+    def producer() -> None:
+        try:
+            stack = [root]
+            while stack and not stop.is_set():
+                subdirectories = [
+                    x
+                    for x in stack.pop().iterdir()
+                    if x.is_dir() and x != hash_location
+                ]
+                stack.extend(reversed(subdirectories))
+                for sub_dir in subdirectories:
+                    if isinstance(hash_location, HashDB):
+                        old_hashes = hash_location.load_directory(sub_dir)
+                        if fastload and old_hashes is not None:
+                            continue
+                        if cache:
+                            old_hashes = None
+                    else:
+                        savefile = hash_location / path_to_id(sub_dir)
+                        if fastload and savefile.is_file():
+                            continue
+                        old_hashes = None if cache else unpickle_this(savefile)
+
+                    # Same file selection and reuse as `directory_hash`
+                    hashes: Dict[str, str] = {}
+                    to_hash = []
+                    for file in file_collector(root=sub_dir, pattern=pattern):
+                        if old_hashes and file.name in old_hashes:
+                            hashes[file.name] = old_hashes[file.name]
+                        else:
+                            to_hash.append(file)
+                    results.put(("directory", sub_dir, hashes, len(to_hash)))
+                    for file in to_hash:
+                        if stop.is_set():
+                            return
+                        files_to_hash.put((sub_dir, file))
+        except Exception as e:
+            results.put(("error", e))
+        finally:
+            for _ in range(workers):
+                files_to_hash.put(None)
+
+    def worker() -> None:
+        try:
+            while True:
+                job = files_to_hash.get()
+                if job is None:
+                    return
+                if stop.is_set():
+                    continue
+                sub_dir, file = job
+                try:
+                    digest: Optional[str] = file_hash(file, cache=cache)
+                except OSError as e:
+                    log.warning("tree_hash: couldn't hash '%s': %s", file, e)
+                    digest = None
+                results.put(("file", sub_dir, file, digest))
+        except Exception as e:
+            results.put(("error", e))
+        finally:
+            results.put(("done",))
+
+    def save(sub_dir: Path, hashes: Dict[str, str]) -> None:
+        spinner.animation()
+        if isinstance(hash_location, HashDB):
+            hash_location.save_directory(sub_dir, hashes)
+        else:
+            pickle_this(
+                {"folder": sub_dir, "hashes": hashes},
+                hash_location / path_to_id(sub_dir),
+            )
+
+    producer_thread = threading.Thread(target=producer, daemon=True)
+    worker_threads = [
+        threading.Thread(target=worker, daemon=True) for _ in range(workers)
+    ]
+    for thread in [producer_thread] + worker_threads:
+        thread.start()
+
+    # Directories being hashed: {<directory>: (<hashes>, <number of files left to hash>)}
+    in_progress: Dict[Path, Tuple[Dict[str, str], int]] = {}
+    finished_workers = 0
+    try:
+        while finished_workers < workers:
+            message = results.get()
+            if message[0] == "error":
+                raise message[1]
+            if message[0] == "done":
+                finished_workers += 1
+                continue
+            if message[0] == "directory":
+                _, sub_dir, hashes, remaining = message
+            else:
+                _, sub_dir, file, digest = message
+                hashes, remaining = in_progress.pop(sub_dir)
+                remaining -= 1
+                if digest is not None:
+                    hashes[file.name] = digest
+            if remaining:
+                in_progress[sub_dir] = (hashes, remaining)
+            else:
+                save(sub_dir, hashes)
+    finally:
+        # On error, unblocks producer if it waits for room in the queue, then workers if they
+        # wait for a job
+        stop.set()
+        while producer_thread.is_alive():
+            try:
+                while True:
+                    files_to_hash.get_nowait()
+            except queue.Empty:
+                pass
+            producer_thread.join(timeout=0.1)
+        for thread in worker_threads:
+            while thread.is_alive():
+                try:
+                    files_to_hash.put_nowait(None)
+                except queue.Full:
+                    pass
+                thread.join(timeout=0.1)
+
+
+@dataclass
+class ScrubIssue:
+    """Problem found by `scrub`; `status` is one of `SCRUB_STATUSES`:
+    - 'mismatch': file content doesn't match its recorded hash (`expected`; `actual` is the
+      current hash)
+    - 'missing': recorded file (`expected` is its recorded hash) doesn't exist anymore
+    - 'new': file wasn't recorded
+    - 'unreadable': recorded file exists but couldn't be read
+    """
+
+    status: str
+    path: Path
+    expected: Optional[str] = None
+    actual: Optional[str] = None
+
+
+def scrub(
+    root: Path,
+    hash_db: HashDB,
+    pattern: str = "*.*",
+    workers: Optional[int] = None,
+    max_rate: Optional[int] = None,
+    checkpoint: Optional[Path] = None,
+    batch_size: int = 1000,
+) -> Iterator[ScrubIssue]:
+    """Verifies files under `root` against hashes recorded in `hash_db` by `tree_hash` (with the
+    same `pattern`), to detect silent data corruption (bit rot). Files are rehashed concurrently
+    (see `hash_files`) and issues are yielded as soon as they are found (see `ScrubIssue`);
+    files modified since they were recorded are reported as mismatches.
+
+    Like `tree_hash`, only files in subdirectories of `root` are considered. Directories are
+    verified in lexicographic order, by batches of about `batch_size` files.
+
+    `max_rate`: if given, reads are limited to this many bytes per second on average, so that a
+    scrub can run in the background without hurting other I/O
+
+    `checkpoint`: if given, progress is saved to this file after each batch, and a scrub started
+    with an existing checkpoint file resumes after the last verified directory. The file is
+    deleted once the scrub is complete. Note: a directory created before the last verified one
+    (in lexicographic order) while the scrub was interrupted is not verified until next scrub.
+    """
+    root = root.resolve()
+    assertTrue(root.is_dir(), "Root dir must exist: '{}'", root)
+    assertTrue(
+        max_rate is None or 0 < max_rate, "max_rate must be positive, not {}", max_rate
+    )
+
+    # Recorded and current directories
+    folders = {folder for folder in hash_db.folders() if root in folder.parents}
+    stack = [root]
+    while stack:
+        subdirectories = [x for x in stack.pop().iterdir() if x.is_dir()]
+        folders.update(subdirectories)
+        stack.extend(subdirectories)
+    sorted_folders = sorted(folders, key=str)
+
+    if checkpoint is not None:
+        progress = unpickle_this(checkpoint)
+        if progress is not None and progress["root"] == root:
+            log.info("scrub: resuming after '%s'", progress["folder"])
+            sorted_folders = [
+                folder
+                for folder in sorted_folders
+                if str(progress["folder"]) < str(folder)
+            ]
+
+    hash_files_kwargs: Dict[str, Any] = {"workers": workers}
+    if max_rate is not None:
+        # Bounds reads done ahead of throttling
+        hash_files_kwargs["max_in_flight"] = min(256 * READ_SIZE, max_rate)
+    start, hashed_bytes = time.monotonic(), 0
+
+    position = 0
+    while position < len(sorted_folders):
+        # Builds a batch of directories
+        expected: Dict[Path, str] = {}
+        to_verify: List[Path] = []
+        while position < len(sorted_folders) and len(to_verify) < batch_size:
+            folder = sorted_folders[position]
+            position += 1
+            recorded = hash_db.load_directory(folder) or {}
+            current = (
+                {file.name: file for file in file_collector(folder, pattern)}
+                if folder.is_dir()
+                else {}
+            )
+            for name, digest in recorded.items():
+                if name not in current:
+                    yield ScrubIssue("missing", folder / name, expected=digest)
+            for name, file in current.items():
+                if name not in recorded:
+                    yield ScrubIssue("new", file)
+                    continue
+                expected[file] = recorded[name]
+                to_verify.append(file)
+
+        for file, actual in hash_files(to_verify, **hash_files_kwargs):
+            if actual is None:
+                yield ScrubIssue("unreadable", file, expected=expected[file])
+            elif actual != expected[file]:
+                yield ScrubIssue("mismatch", file, expected[file], actual)
+
+            if max_rate is not None:
+                try:
+                    hashed_bytes += file.stat().st_size
+                except OSError:
+                    pass
+                delay = start + hashed_bytes / max_rate - time.monotonic()
+                if 0 < delay:
+                    time.sleep(delay)
+
+        if checkpoint is not None:
+            pickle_this(
+                {"root": root, "folder": sorted_folders[position - 1]}, checkpoint
+            )
+
+    if checkpoint is not None and checkpoint.is_file():
+        checkpoint.unlink()
 
 
 def get_temporary_dir_name(file: Path) -> str:
@@ -5,7 +5,8 @@
 Path tools
 ==========
 
-Easy to use tool to collect files matching a pattern.
+Easy to use tool to collect files matching a pattern, and gitignore-style
+exclusion rules (see `PruneRules`) to avoid walking uninteresting directory trees.
 
 Note: both class and function versions should be euivalent, both kept
 just in case. Class may be usefull for repeated calls to `collect` method.
@@ -13,12 +14,13 @@ just in case. Class may be usefull for repeated calls to `collect` method.
 """
 
 import logging
+import os
 import re
 import sys
 from os import popen
 from pathlib import Path
 from shutil import copy2
-from typing import List, Optional, Tuple, Union
+from typing import Iterable, List, Optional, Tuple, Union
 
 from send2trash import send2trash
 
@@ -72,53 +74,188 @@ except ImportError:
         LOG.warning("Could not import optional dependency win32api; This shou")
 
 
+def _glob_to_regex(pattern: str) -> str:
+    """Translates a glob to a regex matching relative posix-style paths: `*` and `?` don't match
+    '/', `**` matches any number of directories (``**/x``, ``a/**/x``, ``a/**``) and character
+    classes (``[abc]``, ``[!abc]``) are supported."""
+    res = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        at_segment_start = i == 0 or pattern[i - 1] == "/"
+        if at_segment_start and pattern.startswith("**/", i):
+            res.append("(?:.*/)?")
+            i += 3
+        elif at_segment_start and pattern.startswith("**", i) and i + 2 == n:
+            res.append(".*")
+            i += 2
+        elif c == "*":
+            res.append("[^/]*")
+            i += 1
+        elif c == "?":
+            res.append("[^/]")
+            i += 1
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            j = pattern.find("]", j)
+            if j == -1:
+                res.append(re.escape(c))
+                i += 1
+                continue
+            chars = pattern[i + 1 : j].replace("\\", "\\\\")
+            if chars[0] in "!^":
+                chars = "^" + chars[1:]
+            res.append(f"[{chars}]")
+            i = j + 1
+        else:
+            res.append(re.escape(c))
+            i += 1
+    return "".join(res)
+
+
+class PruneRules:
+    """Gitignore-style exclusion rules, checked on each entry before descending into it, so
+    excluded directory trees are never walked (eg: ``.git``, ``node_modules``, snapshot folders).
+    Used by `file_collector`, `fsdb.FSindex`, `fsdb.FSscan`/`fsdb.CachedFS` (see
+    `fsdb.ScanFilter.prune`) and `fsdb.get_folder_snapshot`.
+
+    Patterns are matched against paths relative to the walk's root, posix-style:
+     - blank lines and lines starting with '#' are ignored
+     - a pattern without '/' matches entries with that name at any depth (eg: ``*.tmp``)
+     - a pattern containing a '/' (except a trailing one) is relative to the root
+       (eg: ``build/cache``, ``/dist``)
+     - a trailing '/' only matches directories (eg: ``node_modules/``)
+     - wildcards: see `_glob_to_regex`
+     - ``!pattern`` re-includes entries excluded by a previous pattern; the last matching pattern
+       wins. Like git, entries in an excluded directory can't be re-included since it isn't walked
+
+    `defaults`: whether to add `DEFAULT_PATTERNS`, which excludes Windows' recycle bin.
+    """
+
+    DEFAULT_PATTERNS = ("$RECYCLE.BIN",)
+
+    def __init__(self, patterns: Iterable[str] = (), defaults: bool = True) -> None:
+        self.patterns = (list(self.DEFAULT_PATTERNS) if defaults else []) + [
+            pattern.strip()
+            for pattern in patterns
+            if pattern.strip() and not pattern.strip().startswith("#")
+        ]
+        self._rules: List[Tuple[re.Pattern, bool, bool]] = []
+        for pattern in self.patterns:
+            negate = pattern.startswith("!")
+            if negate or pattern.startswith("\\"):
+                pattern = pattern[1:]
+            directories_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            regex = _glob_to_regex(pattern.lstrip("/"))
+            if "/" not in pattern:
+                regex = "(?:.*/)?" + regex
+            self._rules.append((re.compile(regex + "$"), negate, directories_only))
+
+        # Without negation, rules are combined into two regexes (any entry/directories only)
+        self._combined: Optional[Tuple[Optional[re.Pattern], Optional[re.Pattern]]] = (
+            None
+        )
+        if not any(negate for _, negate, _ in self._rules):
+            self._combined = tuple(  # type: ignore[assignment]
+                re.compile("|".join(regexes)) if regexes else None
+                for regexes in (
+                    [r.pattern for r, _, dir_only in self._rules if not dir_only],
+                    [r.pattern for r, _, dir_only in self._rules if dir_only],
+                )
+            )
+
+    @classmethod
+    def from_file(cls, file: Path, defaults: bool = True) -> "PruneRules":
+        """Reads patterns from a file (eg: a ``.gitignore``), one per line"""
+        return cls(file.read_text(encoding="utf8").splitlines(), defaults)
+
+    def __bool__(self) -> bool:
+        return bool(self._rules)
+
+    def excludes(self, rel_path: str, is_dir: bool) -> bool:
+        """Returns True if entry at `rel_path` (relative to the walk's root, posix-style) is
+        excluded, ie: it must be skipped and, if it's a directory, not walked."""
+        if self._combined is not None:
+            any_entry, directories_only = self._combined
+            return bool(
+                (any_entry and any_entry.match(rel_path))
+                or (is_dir and directories_only and directories_only.match(rel_path))
+            )
+        for regex, negate, directories_only in reversed(self._rules):
+            if directories_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                return not negate
+        return False
+
+
 class FileCollector:
-    """Easy to use tool to collect files matching a pattern (recursive or not), using pathlib.glob.
+    """Easy to use tool to collect files matching a pattern (recursive or not), see `file_collector`.
     Reasoning for making it a class: Making cohexist an initial check/processing on root with a recursive
     main function was not straightforward. I did it anyway, so feel free to use the function alternative.
     """
 
-    def __init__(self, root: Path) -> None:
+    def __init__(self, root: Path, prune: Optional[PruneRules] = None) -> None:
         assertTrue(root.is_dir(), "Root dir must exist: '{}'", root)
         root.resolve()
         self.root = root
+        self.prune = prune
         self.log = logging.getLogger(__file__)
         self.log.debug("root=%s", root)
 
     def collect(self, pattern: str = "**/*.*") -> List[Path]:
         """Collect files matching given pattern(s)"""
-        files = []
-
-        # 11/11/2020 BUGFIX : was collecting files in trash like a cyber racoon
-        files = [
+        return [
             item.resolve()
-            for item in self.root.glob(pattern)
-            if item.is_file() and ("$RECYCLE.BIN" not in item.parts)
+            for item in file_collector(self.root, pattern, prune=self.prune)
         ]
 
-        self.log.debug("\t'%s': Found %s files in %s", pattern, len(files), self.root)
-
-        return files
 
+def file_collector(
+    root: Path, pattern: str = "**/*.*", prune: Optional[PruneRules] = None
+) -> List[Path]:
+    """Easy to use tool to collect files matching a pattern (recursive or not), with the same
+    syntax as pathlib.glob (see `_glob_to_regex`; case insensitive on Windows).
+    Collect files matching given pattern(s)
 
-def file_collector(root: Path, pattern: str = "**/*.*") -> List[Path]:
-    """Easy to use tool to collect files matching a pattern (recursive or not), using pathlib.glob.
-    Collect files matching given pattern(s)"""
+    `prune`: exclusion rules; excluded directories are not walked. Default: `PruneRules()`, which
+    excludes Windows' recycle bin.
+    """
     assertTrue(root.is_dir(), "Root dir must exist: '{}'", root)
     root.resolve()
     LOG.debug("root=%s", root)
-
-    def collect(_pattern: str) -> List[Path]:
-        # 11/11/2020 BUGFIX : was collecting files in trash like a cyber racoon
-        _files = [
-            item
-            for item in root.glob(_pattern)
-            if item.is_file() and ("$RECYCLE.BIN" not in item.parts)
-        ]
-        LOG.debug("\t'%s': Found %s files in %s", _pattern, len(_files), root)
-        return _files
-
-    files = collect(pattern)
+    rules = PruneRules() if prune is None else prune
+    matcher = re.compile(
+        _glob_to_regex(pattern) + "$",
+        flags=re.IGNORECASE if sys.platform == "win32" else 0,
+    )
+    # Without '**', pattern can't match beyond a fixed depth
+    max_depth = None if "**" in pattern else pattern.count("/")
+
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = Path(os.path.relpath(dirpath, root)).as_posix()
+        prefix = "" if rel_dir == "." else rel_dir + "/"
+        if max_depth is not None and prefix.count("/") >= max_depth:
+            dirnames.clear()
+        else:
+            dirnames[:] = [
+                name for name in dirnames if not rules.excludes(prefix + name, True)
+            ]
+        for name in filenames:
+            rel_path = prefix + name
+            if (
+                matcher.match(rel_path)
+                and not rules.excludes(rel_path, False)
+                and os.path.isfile(os.path.join(dirpath, name))
+            ):
+                files.append(root / rel_path)
+    LOG.debug("\t'%s': Found %s files in %s", pattern, len(files), root)
 
     return files
 
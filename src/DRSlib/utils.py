@@ -8,8 +8,10 @@ import collections
 import inspect
 import logging
 import pickle
+import sqlite3
+import threading
 from pathlib import Path
-from typing import Any, Callable, Optional, Tuple, Union
+from typing import Any, Callable, Optional, Tuple, TypeVar, Union
 
 LOG = logging.getLogger(__file__)
 
@@ -128,3 +130,58 @@ def cast_number(number: str) -> int | float | str:
             return float(number)
         except ValueError:
             return number
+
+
+SQLiteDatabaseT = TypeVar("SQLiteDatabaseT", bound="SQLiteDatabase")
+
+
+class SQLiteDatabase:
+    """Base class for stores kept in a single SQLite database file (in WAL mode), shared by
+    threads: subclasses define `SCHEMA` and must hold `_lock` while using `_db`.
+
+    Writes are grouped into transactions of up to `batch_size` writes (see `_written`); call
+    `flush` or `close` to commit pending writes. Thread-safe.
+    """
+
+    # Statements executed on opening, eg: CREATE TABLE IF NOT EXISTS
+    SCHEMA: Tuple[str, ...] = ()
+
+    def __init__(self, db_file: Path, batch_size: int = 1000) -> None:
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(db_file), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        for statement in self.SCHEMA:
+            self._db.execute(statement)
+        self._db.commit()
+
+    def _written(self, count: int = 1) -> None:
+        """Records `count` writes, committing if batch is full; caller must hold lock"""
+        self._pending += count
+        if self.batch_size <= self._pending:
+            self._db.commit()
+            self._pending = 0
+
+    def _write(self, query: str, parameters: tuple) -> None:
+        """Executes a write query; caller must hold lock"""
+        self._db.execute(query, parameters)
+        self._written()
+
+    def flush(self) -> None:
+        """Commits pending writes"""
+        with self._lock:
+            self._db.commit()
+            self._pending = 0
+
+    def close(self) -> None:
+        """Commits pending writes and closes database"""
+        self.flush()
+        self._db.close()
+
+    def __enter__(self: SQLiteDatabaseT) -> SQLiteDatabaseT:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
@@ -0,0 +1,65 @@
+import threading
+from pathlib import Path
+
+import pytest
+
+from DRSlib import hash as drs_hash
+
+
+def test_tree_hash_parallel_reraises_worker_errors(tmp_path: Path, monkeypatch) -> None:
+    """An unexpected error while hashing a file must be raised, not hang `tree_hash`"""
+    root = tmp_path / "root"
+    for directory in ("a", "b"):
+        (root / directory).mkdir(parents=True)
+        for i in range(3):
+            (root / directory / f"{i}.txt").write_text(f"{directory}{i}")
+    file_hash = drs_hash.file_hash
+
+    def failing_file_hash(file: Path, *args, **kwargs) -> str:
+        if file.name == "1.txt" and file.parent.name == "b":
+            raise ValueError("boom")
+        return file_hash(file, *args, **kwargs)
+
+    monkeypatch.setattr(drs_hash, "file_hash", failing_file_hash)
+
+    errors = []
+
+    def run() -> None:
+        try:
+            with drs_hash.HashDB(tmp_path / "hashes.db") as hash_db:
+                drs_hash.tree_hash(root, hash_db, workers=2)
+        except ValueError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive(), "tree_hash hung on a worker error"
+    assert len(errors) == 1 and str(errors[0]) == "boom"
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_tree_hash_reuses_hash_db_hashes(
+    tmp_path: Path, monkeypatch, workers: int
+) -> None:
+    """Like with pickle files, files already recorded in a `HashDB` aren't hashed again"""
+    root = tmp_path / "root"
+    (root / "a").mkdir(parents=True)
+    for i in range(3):
+        (root / "a" / f"{i}.txt").write_text(str(i))
+
+    hashed = []
+    file_hash = drs_hash.file_hash
+
+    def counting_file_hash(file: Path, *args, **kwargs) -> str:
+        hashed.append(file)
+        return file_hash(file, *args, **kwargs)
+
+    monkeypatch.setattr(drs_hash, "file_hash", counting_file_hash)
+
+    with drs_hash.HashDB(tmp_path / "hashes.db") as hash_db:
+        drs_hash.tree_hash(root, hash_db, workers=workers)
+        assert len(hashed) == 3
+        drs_hash.tree_hash(root, hash_db, workers=workers)
+        assert len(hashed) == 3
+        assert len(hash_db.load_directory(root / "a")) == 3